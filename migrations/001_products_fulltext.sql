@@ -0,0 +1,4 @@
+-- Full-text index backing the ?search= filter on GET /api/products.
+-- Until this index exists the API falls back to LIKE '%term%' matching.
+ALTER TABLE products
+    ADD FULLTEXT INDEX ft_products_name_description (name, description);
@@ -0,0 +1,7 @@
+-- Unique keys that let POST /api/cart/add upsert carts and cart lines atomically.
+-- Merge any duplicate rows before applying.
+ALTER TABLE carts
+    ADD UNIQUE KEY uq_carts_user (user_id);
+
+ALTER TABLE cart_items
+    ADD UNIQUE KEY uq_cart_items_cart_product (cart_id, product_id);
@@ -0,0 +1,21 @@
+-- Durable queue for M-Pesa STK push requests, drained by the payment workers
+-- in sarai.py. Expects payments(id, order_id, amount, payment_method, status)
+-- and mpesa_transactions(payment_id, checkout_request_id) to exist already.
+-- FOR UPDATE SKIP LOCKED requires MySQL 8.0+ or MariaDB 10.6+.
+CREATE TABLE payment_jobs (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    payment_id INT NOT NULL,
+    phone VARCHAR(20) NOT NULL,
+    amount DECIMAL(10, 2) NOT NULL,
+    status ENUM('queued', 'processing', 'submitted', 'failed') NOT NULL DEFAULT 'queued',
+    attempts INT NOT NULL DEFAULT 0,
+    next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_until DATETIME NULL,
+    last_error VARCHAR(255) NULL,
+    checkout_request_id VARCHAR(100) NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    UNIQUE KEY uq_payment_jobs_payment (payment_id),
+    KEY idx_payment_jobs_due (status, next_attempt_at),
+    CONSTRAINT fk_payment_jobs_payment FOREIGN KEY (payment_id) REFERENCES payments (id) ON DELETE CASCADE
+);
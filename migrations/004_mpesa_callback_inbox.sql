@@ -0,0 +1,18 @@
+-- Durable inbox for M-Pesa STK callbacks. /api/mpesa_callback only appends
+-- here; the callback processor in sarai.py applies rows in batches. The
+-- unique key drops Safaricom's retried deliveries at ingest.
+CREATE TABLE mpesa_callback_inbox (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    checkout_request_id VARCHAR(100) NOT NULL,
+    result_code INT NULL,
+    payload TEXT NOT NULL,
+    received_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+    processed_at DATETIME(3) NULL,
+    outcome VARCHAR(20) NULL,
+    UNIQUE KEY uq_callback_inbox_checkout (checkout_request_id),
+    KEY idx_callback_inbox_pending (processed_at, id)
+);
+
+-- Lets the processor match a batch of callbacks to payments in one lookup
+ALTER TABLE mpesa_transactions
+    ADD INDEX idx_mpesa_transactions_checkout (checkout_request_id);
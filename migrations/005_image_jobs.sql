@@ -0,0 +1,24 @@
+-- Background image processing queue, drained by the image workers in
+-- sarai.py, and the rendered variants of each product image. Existing product
+-- images are queued so their variants are backfilled.
+-- FOR UPDATE SKIP LOCKED requires MySQL 8.0+ or MariaDB 10.6+.
+CREATE TABLE image_jobs (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    kind ENUM('product_image', 'avatar') NOT NULL,
+    target_id INT NOT NULL,
+    source VARCHAR(255) NOT NULL,
+    status ENUM('queued', 'processing', 'done', 'failed') NOT NULL DEFAULT 'queued',
+    attempts INT NOT NULL DEFAULT 0,
+    next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_until DATETIME NULL,
+    last_error VARCHAR(255) NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    KEY idx_image_jobs_due (status, next_attempt_at)
+);
+
+ALTER TABLE product_images ADD COLUMN variants JSON NULL;
+
+INSERT INTO image_jobs (kind, target_id, source)
+SELECT 'product_image', id, image_url
+FROM product_images;
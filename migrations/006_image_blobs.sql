@@ -0,0 +1,11 @@
+-- Reference counts for content-addressed uploads (UPLOAD_FOLDER/ab/cd/<sha256>.<ext>).
+-- Each product_images row and each users.avatar_url pointing at a blob holds
+-- one reference. Images uploaded before this table existed keep their plain
+-- file names and are not tracked here.
+CREATE TABLE image_blobs (
+    hash CHAR(64) NOT NULL PRIMARY KEY,
+    path VARCHAR(255) NOT NULL,
+    size INT NOT NULL,
+    refcount INT NOT NULL DEFAULT 0,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,5 @@
+-- STK pushes whose outcome is unknown (read timeout, 5xx, worker crash) are
+-- parked instead of resent, because a second push can charge the customer twice.
+ALTER TABLE payment_jobs
+    MODIFY status ENUM('queued', 'processing', 'submitted', 'unknown', 'failed') NOT NULL DEFAULT 'queued',
+    ADD KEY idx_payment_jobs_phone (status, phone);
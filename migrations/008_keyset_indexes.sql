@@ -0,0 +1,13 @@
+-- Indexes backing the keyset pagination on GET /api/products, /api/orders and
+-- /api/users, which page by ORDER BY created_at DESC, id DESC with a
+-- (created_at, id) < (cursor) condition. Without them each page is a full
+-- scan and filesort, and deep pages get slower the further the cursor is.
+ALTER TABLE products
+    ADD INDEX idx_products_created (created_at, id),
+    ADD INDEX idx_products_category_created (category_id, created_at, id);
+
+ALTER TABLE orders
+    ADD INDEX idx_orders_created (created_at, id);
+
+ALTER TABLE users
+    ADD INDEX idx_users_created (created_at, id);
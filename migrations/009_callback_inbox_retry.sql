@@ -0,0 +1,4 @@
+-- Callbacks that match no payment yet are retried after retry_at instead of
+-- being re-read by every batch, so they cannot hold back newer callbacks.
+ALTER TABLE mpesa_callback_inbox
+    ADD COLUMN retry_at DATETIME(3) NULL AFTER received_at;
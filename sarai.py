@@ -1,18 +1,42 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Request, Response, request, jsonify, g, has_request_context
 from flask_cors import CORS
+from werkzeug.http import is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
 import pymysql
 import pymysql.cursors
+from pymysql.constants import SERVER_STATUS
 import os
-from werkzeug.utils import secure_filename
 import datetime
 import base64
+import json
 import requests
+import urllib3
 from requests.auth import HTTPBasicAuth
 from functools import wraps
 import jwt
 from dotenv import load_dotenv
+try:
+    import redis
+except ImportError:
+    redis = None
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
 import uuid
+import hashlib
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import threading
+import time
+import random
+import heapq
+import queue
+import mimetypes
+from collections import deque, OrderedDict
 
 # Load environment variables
 load_dotenv()
@@ -20,8 +44,58 @@ load_dotenv()
 app = Flask(__name__)
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+app.config['LOG_LEVEL'] = os.getenv('LOG_LEVEL', 'INFO')
+app.config['ACCESS_LOG_SAMPLE_RATE'] = float(os.getenv('ACCESS_LOG_SAMPLE_RATE', '1.0'))  # fraction of ordinary requests logged
+app.config['ACCESS_LOG_SLOW_MS'] = 1000  # slower requests and 5xx responses are always logged
+app.config['LOG_HEADERS'] = os.getenv('LOG_HEADERS', 'false').lower() == 'true'  # header dumps, also on in debug mode
+
+# One JSON object per line. Extra structured fields are passed as extra={'fields': {...}}.
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        if getattr(record, 'request_id', None):
+            entry['request_id'] = record.request_id
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id')
+        return True
+
+# Request threads only put records on a queue; a listener thread formats and
+# writes them, so slow log I/O never holds up a response. The listener thread
+# does not survive a fork and is started again in each child.
+log_queue = queue.SimpleQueue()
+log_output = logging.StreamHandler()
+log_output.setFormatter(JsonLogFormatter())
+log_listener = None
+
+def start_log_listener():
+    global log_listener
+    log_listener = QueueListener(log_queue, log_output)
+    log_listener.start()
+
+def stop_log_listener():
+    if log_listener is not None:
+        log_listener.stop()
+
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))  # basicConfig would add a level/name prefix
+queue_handler.addFilter(RequestIdFilter())
+logging.basicConfig(level=app.config['LOG_LEVEL'], handlers=[queue_handler])
+start_log_listener()
+os.register_at_fork(after_in_child=start_log_listener)
+atexit.register(stop_log_listener)
+
 logger = logging.getLogger(__name__)
+access_logger = logging.getLogger('sarai.access')
 
 # Updated CORS Configuration
 CORS(
@@ -33,7 +107,7 @@ CORS(
                 "https://saraicollection.pythonanywhere.com",
                 "https://saraicollection.vercel.app"
             ],
-            "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+            "methods": ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
             "allow_headers": ["Content-Type", "Authorization"],
             "supports_credentials": True,
             "expose_headers": ["Content-Type"],
@@ -47,13 +121,94 @@ app.config['UPLOAD_FOLDER'] = '/home/saraicollection/mysite/static/images'
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif'}
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-very-secret-key-here')
+app.config['AUTH_CACHE_MAX_ENTRIES'] = 10000  # verified tokens kept in memory
+app.config['AUTH_CACHE_MAX_TTL'] = 3600  # seconds a verified token is trusted without re-checking the signature
+app.config['SUSPENSION_REFRESH_INTERVAL'] = 30  # seconds between reloads of suspended user ids
+app.config['BCRYPT_ROUNDS'] = int(os.getenv('BCRYPT_ROUNDS', '12'))
+app.config['BCRYPT_WORKERS'] = int(os.getenv('BCRYPT_WORKERS', '2'))  # 0 hashes on the request thread
+app.config['BCRYPT_MAX_PENDING'] = int(os.getenv('BCRYPT_MAX_PENDING', '16'))
+app.config['BCRYPT_TIMEOUT'] = 10  # seconds
+app.config['BCRYPT_RETRY_AFTER'] = 2  # seconds suggested to clients when hashing is saturated
+app.config['DEFAULT_PAGE_SIZE'] = 24
+app.config['MAX_PAGE_SIZE'] = 100
+app.config['MAX_CART_OPERATIONS'] = 100
+app.config['CART_SUMMARY_TTL'] = 60  # seconds; cached only with CACHE_BACKEND=redis, cart writes also invalidate explicitly
+app.config['SSE_HEARTBEAT'] = 15  # seconds between keep-alive comments on event streams
+app.config['SSE_MAX_DURATION'] = 300  # streams close after this long and the client reconnects; each open stream holds a worker thread until then
+app.config['CATALOG_CACHE_TTL'] = float(os.getenv('CATALOG_CACHE_TTL', '300'))  # seconds
+app.config['CATALOG_CACHE_MAX_ENTRIES'] = int(os.getenv('CATALOG_CACHE_MAX_ENTRIES', '512'))
+app.config['CACHE_BACKEND'] = os.getenv('CACHE_BACKEND', 'memory')  # 'memory' or 'redis'
+app.config['CACHE_REDIS_URL'] = os.getenv('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+app.config['PRODUCTS_MAX_AGE'] = 60  # browser Cache-Control max-age for product responses
+app.config['CATEGORIES_MAX_AGE'] = 300
+app.config['RATE_LIMIT_BACKEND'] = os.getenv('RATE_LIMIT_BACKEND', app.config['CACHE_BACKEND'])  # 'memory' or 'redis'
+app.config['RATE_LIMIT_MAX_KEYS'] = 100000  # in-memory counters kept before stale ones are pruned
+# Reverse proxies in front of the app. X-Forwarded-For is only trusted for this
+# many hops (0 = use the socket address); clients can forge any entry beyond them.
+app.config['PROXY_HOPS'] = int(os.getenv('PROXY_HOPS', '0'))
+if app.config['PROXY_HOPS'] > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_HOPS'])
+# (max requests, window seconds) per scope for each limited endpoint
+app.config['RATE_LIMITS'] = {
+    'login': {'ip': (30, 60), 'email': (5, 60)},
+    'register': {'ip': (10, 3600), 'email': (3, 3600)},
+}
 
-# MPESA Configuration
-app.config['MPESA_CONSUMER_KEY'] = os.getenv('MPESA_CONSUMER_KEY')
-app.config['MPESA_CONSUMER_SECRET'] = os.getenv('MPESA_CONSUMER_SECRET')
-app.config['MPESA_PASSKEY'] = os.getenv('MPESA_PASSKEY')
+# MPESA Configuration (defaults are the public Daraja sandbox credentials)
+app.config['MPESA_BASE_URL'] = os.getenv('MPESA_BASE_URL', 'https://sandbox.safaricom.co.ke')
+app.config['MPESA_CONSUMER_KEY'] = os.getenv('MPESA_CONSUMER_KEY', 'GTWADFxIpUfDoNikNGqq1C3023evM6UH')
+app.config['MPESA_CONSUMER_SECRET'] = os.getenv('MPESA_CONSUMER_SECRET', 'amFbAoUByPV2rM5A')
+app.config['MPESA_PASSKEY'] = os.getenv('MPESA_PASSKEY', 'bfb279f9aa9bdbcf158e97dd71a467cd2e0c893059b10f78e6b72ada1ed2c919')
 app.config['MPESA_BUSINESS_SHORTCODE'] = os.getenv('MPESA_BUSINESS_SHORTCODE', '174379')
-app.config['MPESA_CALLBACK_URL'] = os.getenv('MPESA_CALLBACK_URL', 'https://yourdomain.com/api/mpesa_callback')
+app.config['MPESA_CALLBACK_URL'] = os.getenv('MPESA_CALLBACK_URL', 'https://saraicollection.pythonanywhere.com/api/mpesa_callback')
+app.config['MPESA_TEST_AMOUNT'] = os.getenv('MPESA_TEST_AMOUNT', '1')  # charged instead of the order total; set empty for live payments
+app.config['MPESA_TIMEOUT'] = float(os.getenv('MPESA_TIMEOUT', '10'))  # seconds per Daraja HTTP call
+app.config['MPESA_TOKEN_REFRESH_MARGIN'] = 300  # refresh the OAuth token this many seconds before it expires
+
+# Payment worker settings
+app.config['PAYMENT_WORKERS'] = int(os.getenv('PAYMENT_WORKERS', '2'))
+app.config['PAYMENT_MAX_ATTEMPTS'] = int(os.getenv('PAYMENT_MAX_ATTEMPTS', '5'))
+app.config['PAYMENT_BACKOFF_BASE'] = 2.0  # seconds before the first retry, doubled per attempt
+app.config['PAYMENT_BACKOFF_MAX'] = 300.0
+app.config['PAYMENT_POLL_INTERVAL'] = 5.0  # seconds between queue polls when idle
+app.config['PAYMENT_LEASE'] = 60  # seconds a claimed job may run before it is presumed crashed and parked as unknown
+app.config['PAYMENT_UNKNOWN_TIMEOUT'] = 1800  # seconds an unknown-outcome push waits for a callback before the payment fails
+app.config['CALLBACK_BATCH_SIZE'] = 100
+app.config['CALLBACK_POLL_INTERVAL'] = 1.0
+app.config['CALLBACK_UNMATCHED_AFTER'] = 600  # seconds to wait for a payment to match a callback before giving up
+app.config['CALLBACK_RETRY_INTERVAL'] = 15  # seconds before an unmatched callback is looked at again
+
+# Image processing settings
+app.config['IMAGE_WORKERS'] = int(os.getenv('IMAGE_WORKERS', '1'))
+app.config['IMAGE_FORMATS'] = os.getenv('IMAGE_FORMATS', 'avif,webp').split(',')  # dropped at startup if Pillow cannot encode them
+app.config['IMAGE_QUALITY'] = {'avif': 55, 'webp': 80}
+app.config['IMAGE_VARIANTS'] = {'thumb': 160, 'card': 480, 'detail': 1200}  # longest edge in pixels
+app.config['AVATAR_SIZE'] = 256
+app.config['IMAGE_MAX_PIXELS'] = 40_000_000  # larger uploads are rejected as decompression bombs
+app.config['IMAGE_MAX_ATTEMPTS'] = 3
+app.config['IMAGE_POLL_INTERVAL'] = 10.0
+app.config['IMAGE_LEASE'] = 300  # seconds a claimed job stays locked before another worker may retry it
+app.config['IMAGE_INVALIDATE_INTERVAL'] = 5.0  # seconds between catalog cache flushes while a backlog drains
+
+# Static image serving
+app.config['STATIC_SENDFILE'] = os.getenv('STATIC_SENDFILE', 'wsgi')  # 'wsgi', 'x-sendfile' or 'x-accel-redirect'
+app.config['STATIC_ACCEL_PREFIX'] = os.getenv('STATIC_ACCEL_PREFIX', '/protected-images/')  # nginx internal location for UPLOAD_FOLDER
+app.config['STATIC_IMMUTABLE_MAX_AGE'] = 31536000  # content-hashed files never change
+app.config['STATIC_MAX_AGE'] = 3600  # legacy plain-named files may be overwritten
+app.config['STATIC_STAT_TTL'] = 60  # seconds a file's size/mtime is trusted without re-stat
+app.config['STATIC_STAT_MAX_ENTRIES'] = 4096
+
+# Adds each query's duration to the current request's DB time for the access log
+class TimedCursor(pymysql.cursors.DictCursor):
+    def execute(self, query, args=None):
+        if not has_request_context():
+            return super().execute(query, args)
+        started = time.perf_counter()
+        try:
+            return super().execute(query, args)
+        finally:
+            g.db_time = g.get('db_time', 0.0) + time.perf_counter() - started
+            g.db_queries = g.get('db_queries', 0) + 1
 
 # Database Configuration
 db_config = {
@@ -61,18 +216,265 @@ db_config = {
     'user': os.getenv('DB_USER', 'saraicollection'),
     'password': os.getenv('DB_PASSWORD', 'unknownsara123'),
     'database': os.getenv('DB_NAME', 'saraicollection$saraicollections'),
-    'cursorclass': pymysql.cursors.DictCursor
+    'cursorclass': TimedCursor
 }
 
+# Connection pool settings
+app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', '10'))
+app.config['DB_POOL_TIMEOUT'] = float(os.getenv('DB_POOL_TIMEOUT', '5'))  # seconds to wait for a free connection
+app.config['DB_POOL_RECYCLE'] = float(os.getenv('DB_POOL_RECYCLE', '3600'))  # max connection lifetime in seconds
+app.config['DB_POOL_IDLE_TIMEOUT'] = float(os.getenv('DB_POOL_IDLE_TIMEOUT', '300'))  # evict connections idle this long
+
+class PoolTimeout(Exception):
+    pass
+
+class _PoolEntry:
+    __slots__ = ('conn', 'created_at', 'last_used')
+
+    def __init__(self, conn):
+        now = time.monotonic()
+        self.conn = conn
+        self.created_at = now
+        self.last_used = now
+
+# Wraps a pooled pymysql connection so `with connection:` returns it to the pool instead of closing it
+class PooledConnection:
+    def __init__(self, pool, entry):
+        self._pool = pool
+        self._entry = entry
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._entry is not None:
+            entry, self._entry = self._entry, None
+            self._pool.release(entry)
+
+    def __getattr__(self, name):
+        if self._entry is None:
+            raise pymysql.err.InterfaceError("Connection already returned to the pool")
+        return getattr(self._entry.conn, name)
+
+class ConnectionPool:
+    def __init__(self, config, max_size=10, timeout=5.0, max_lifetime=3600.0, idle_timeout=300.0):
+        self._config = config
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.idle_timeout = idle_timeout
+        self._idle = deque()
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            'created': 0,
+            'recycled': 0,
+            'evicted_idle': 0,
+            'failed_pings': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0
+        }
+
+    def _connect(self):
+        entry = _PoolEntry(pymysql.connect(**self._config))
+        with self._cond:
+            self._stats['created'] += 1
+        return entry
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _evict_idle(self, now):
+        # Oldest idle connections sit at the left end of the deque
+        evicted = []
+        while self._idle and now - self._idle[0].last_used > self.idle_timeout:
+            evicted.append(self._idle.popleft())
+        self._stats['evicted_idle'] += len(evicted)
+        return evicted
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        waited_since = None
+        timed_out = False
+        entry = None
+        evicted = []
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                evicted.extend(self._evict_idle(now))
+                if self._idle:
+                    entry = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._in_use + len(self._idle) < self.max_size:
+                    self._in_use += 1
+                    break
+                if waited_since is None:
+                    waited_since = now
+                    self._stats['waits'] += 1
+                remaining = deadline - now
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    timed_out = True
+                    break
+                self._cond.wait(remaining)
+            if waited_since is not None:
+                self._stats['wait_time'] += time.monotonic() - waited_since
+
+        for stale in evicted:
+            self._close_quietly(stale.conn)
+        if timed_out:
+            raise PoolTimeout(f"Timed out after {self.timeout}s waiting for a database connection")
+
+        try:
+            entry = self._checkout(entry)
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return PooledConnection(self, entry)
+
+    def _checkout(self, entry):
+        if entry is None:
+            return self._connect()
+
+        if time.monotonic() - entry.created_at > self.max_lifetime:
+            self._close_quietly(entry.conn)
+            with self._cond:
+                self._stats['recycled'] += 1
+            return self._connect()
+
+        try:
+            entry.conn.ping(reconnect=False)
+        except Exception:
+            self._close_quietly(entry.conn)
+            with self._cond:
+                self._stats['failed_pings'] += 1
+            return self._connect()
+        return entry
+
+    def release(self, entry):
+        conn = entry.conn
+        reusable = conn.open
+        if reusable and conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+            # Never hand out a connection with an open transaction (uncommitted writes or a stale snapshot)
+            try:
+                conn.rollback()
+            except Exception:
+                reusable = False
+
+        with self._cond:
+            self._in_use -= 1
+            if reusable:
+                entry.last_used = time.monotonic()
+                self._idle.append(entry)
+            self._cond.notify()
+
+        if not reusable:
+            self._close_quietly(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'max_size': self.max_size,
+                'in_use': self._in_use,
+                'idle': len(self._idle)
+            })
+        stats['wait_time'] = round(stats['wait_time'], 6)
+        return stats
+
+db_pool = ConnectionPool(
+    db_config,
+    max_size=app.config['DB_POOL_SIZE'],
+    timeout=app.config['DB_POOL_TIMEOUT'],
+    max_lifetime=app.config['DB_POOL_RECYCLE'],
+    idle_timeout=app.config['DB_POOL_IDLE_TIMEOUT']
+)
+
 # Database Connection Helper
 def get_db_connection():
-    return pymysql.connect(**db_config)
+    return db_pool.acquire()
 
 # Helper Functions
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
+# Order numbers look like ORD-20240131-9F2C4A7B1E; the random suffix makes them
+# unique without first inserting the order to learn its id
+def generate_order_number():
+    return f"ORD-{datetime.datetime.now().strftime('%Y%m%d')}-{uuid.uuid4().hex[:10].upper()}"
+
+# Records how long each phase of a request took, in milliseconds
+class PhaseTimer:
+    def __init__(self):
+        self.phases = []
+        self._last = time.perf_counter()
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, (now - self._last) * 1000))
+        self._last = now
+
+    def summary(self):
+        return ', '.join(f"{name}={duration:.2f}ms" for name, duration in self.phases)
+
+    def server_timing(self):
+        return ', '.join(f"{name};dur={duration:.2f}" for name, duration in self.phases)
+
+# Keyset pagination helpers. Cursors are opaque to clients and encode the
+# (created_at, id) of the last row on the previous page. The paginated tables
+# carry (created_at, id) indexes from migrations/008_keyset_indexes.sql.
+def encode_cursor(created_at, row_id):
+    raw = json.dumps([created_at.isoformat(), row_id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('utf-8').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded.encode('utf-8')))
+        return datetime.datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+# Returns (page_size, after) when the client asked for a page, None for a legacy full listing
+def get_page_args():
+    cursor = request.args.get('cursor')
+    page_size = request.args.get('page_size')
+    if cursor is None and page_size is None:
+        return None
+
+    size = int(page_size) if page_size and page_size.isdigit() else app.config['DEFAULT_PAGE_SIZE']
+    size = max(1, min(size, app.config['MAX_PAGE_SIZE']))
+    after = decode_cursor(cursor) if cursor else None
+    return size, after
+
+def keyset_condition(alias, after):
+    created_at, row_id = after
+    return (
+        f"({alias}.created_at < %s OR ({alias}.created_at = %s AND {alias}.id < %s))",
+        [created_at, created_at, row_id]
+    )
+
+# Trims the extra look-ahead row and builds the cursor for the next page
+def paginate_rows(rows, page_size):
+    rows = list(rows)
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id'])
+    return rows, next_cursor
+
 # Authentication Functions
 def generate_token(user_id, is_admin=False):
     payload = {
@@ -92,15 +494,41 @@ def token_required(f):
             return jsonify({"error": "Token is missing"}), 401
         try:
             token = token.split()[1]  # Remove Bearer prefix
+        except IndexError:
+            return jsonify({"error": "Token is invalid", "details": "Malformed Authorization header"}), 401
+        error = authenticate_token(token)
+        if error:
+            return error
+        return f(*args, **kwargs)
+    return decorated_function
+
+# Event streams are opened with EventSource, which cannot send headers, so the
+# token may also be passed as ?token=
+def authenticate_stream_request():
+    header = request.headers.get('Authorization', '')
+    token = header.split()[1] if len(header.split()) == 2 else request.args.get('token')
+    if not token:
+        return jsonify({"error": "Token is missing"}), 401
+    return authenticate_token(token)
+
+# Verifies a raw JWT and sets request.user_id / request.is_admin; returns an error response on failure
+def authenticate_token(token):
+    digest = hashlib.sha256(token.encode('utf-8')).digest()
+    data = verified_tokens.get(digest)
+    if data is None:
+        try:
             data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-            request.user_id = data['user_id']
-            request.is_admin = data.get('is_admin', False)
         except jwt.ExpiredSignatureError:
             return jsonify({"error": "Token has expired"}), 401
         except Exception as e:
             return jsonify({"error": "Token is invalid", "details": str(e)}), 401
-        return f(*args, **kwargs)
-    return decorated_function
+        verified_tokens.put(digest, data)
+
+    if suspended_users.contains(data['user_id']):
+        return jsonify({"error": "Account suspended"}), 403
+    request.user_id = data['user_id']
+    request.is_admin = data.get('is_admin', False)
+    return None
 
 def admin_required(f):
     @wraps(f)
@@ -112,19 +540,114 @@ def admin_required(f):
 
 # Password Functions
 import bcrypt
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+class HashingBusy(Exception):
+    pass
+
+# bcrypt runs in a small process pool so login bursts cannot pin the request
+# threads. At most BCRYPT_MAX_PENDING hashes may be queued or running; beyond
+# that callers get HashingBusy and the endpoint answers 503. A slot is freed
+# when its hash actually finishes, not when a caller gives up waiting, and
+# timeouts or a crashed pool are reported as HashingBusy too. The pool uses
+# forkserver so children never inherit pooled DB sockets or worker threads.
+class PasswordHasher:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._slots = threading.BoundedSemaphore(app.config['BCRYPT_MAX_PENDING'])
+        self._stats = {'hashes': 0, 'checks': 0, 'rejected': 0, 'timeouts': 0, 'broken': 0, 'rehashes': 0}
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=app.config['BCRYPT_WORKERS'],
+                    mp_context=multiprocessing.get_context('forkserver')
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def _reset(self):
+        with self._lock:
+            self._executor = None
+
+    def run(self, fn, *args):
+        if app.config['BCRYPT_WORKERS'] <= 0:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            self.count('rejected')
+            raise HashingBusy("Too many password operations in progress")
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BrokenProcessPool as e:
+            self._slots.release()
+            raise self._broken(e)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=app.config['BCRYPT_TIMEOUT'])
+        except FutureTimeoutError as e:
+            future.cancel()
+            self.count('timeouts')
+            raise HashingBusy("Password operation timed out") from e
+        except BrokenProcessPool as e:
+            raise self._broken(e)
+
+    def _broken(self, error):
+        self._reset()
+        self.count('broken')
+        logger.error(f"Password hashing pool broke, restarting it: {str(error)}")
+        busy = HashingBusy("Password hashing pool is restarting")
+        busy.__cause__ = error
+        return busy
+
+    def count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['workers'] = app.config['BCRYPT_WORKERS']
+        stats['rounds'] = app.config['BCRYPT_ROUNDS']
+        return stats
+
+password_hasher = PasswordHasher()
+
+def hashing_busy_response():
+    response = jsonify({"error": "Server is busy, please retry shortly"})
+    response.headers['Retry-After'] = str(app.config['BCRYPT_RETRY_AFTER'])
+    return response, 503
 
 def hash_password(password: str) -> str:
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
+    salt = bcrypt.gensalt(rounds=app.config['BCRYPT_ROUNDS'])
+    hashed = password_hasher.run(bcrypt.hashpw, password.encode('utf-8'), salt)
+    password_hasher.count('hashes')
     return hashed.decode('utf-8')
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     try:
-        return bcrypt.checkpw(
+        result = password_hasher.run(
+            bcrypt.checkpw,
             plain_password.encode('utf-8'),
             hashed_password.encode('utf-8')
         )
-    except (ValueError, TypeError):
+    except (ValueError, TypeError, AttributeError):
+        return False
+    password_hasher.count('checks')
+    return result
+
+# Stored hashes look like $2b$12$<salt+hash>; the second field is the cost
+def password_needs_rehash(hashed_password: str) -> bool:
+    try:
+        return int(hashed_password.split('$')[2]) != app.config['BCRYPT_ROUNDS']
+    except (IndexError, ValueError, AttributeError):
         return False
 
 import re
@@ -142,15 +665,557 @@ def validate_password_complexity(password):
         return False, "Password must contain at least one special character"
     return True, "Password meets complexity requirements"
 
-# Log all responses for debugging
+# ========== CATALOG CACHE ==========
+# Catalog responses are cached as serialized JSON under versioned keys
+# ("catalog:v<version>:<path>?<args>"). Invalidation bumps the version, so every
+# worker sharing the backend stops reading the old entries at once and they age
+# out through TTL/LRU instead of being deleted one by one.
+class MemoryCacheBackend:
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._stats = {'evictions': 0, 'expirations': 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self._stats['expirations'] += 1
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    # Counters live outside the LRU so a version number can never be evicted
+    def get_counter(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'backend': 'memory',
+                'entries': len(self._entries),
+                'max_entries': self.max_entries
+            })
+        return stats
+
+class RedisCacheBackend:
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("CACHE_BACKEND=redis requires the redis package")
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self._client.get(key)
+
+    def set(self, key, value, ttl):
+        self._client.set(key, value, ex=max(1, int(ttl)))
+
+    def get_counter(self, key):
+        value = self._client.get(key)
+        return int(value) if value is not None else 0
+
+    def incr(self, key):
+        return self._client.incr(key)
+
+    def delete(self, key):
+        self._client.delete(key)
+
+    def stats(self):
+        return {'backend': 'redis'}
+
+def create_cache_backend():
+    if app.config['CACHE_BACKEND'] == 'redis':
+        return RedisCacheBackend(app.config['CACHE_REDIS_URL'])
+    return MemoryCacheBackend(max_entries=app.config['CATALOG_CACHE_MAX_ENTRIES'])
+
+class ResponseCache:
+    def __init__(self, backend, namespace, ttl=300.0):
+        self.backend = backend
+        self.namespace = namespace
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _key(self, key, version):
+        return f"{self.namespace}:v{version}:{key}"
+
+    # Returns None when the backend is unreachable; callers then skip caching
+    def current_version(self):
+        try:
+            return self.backend.get_counter(f"{self.namespace}:version")
+        except Exception as e:
+            self._count('errors')
+            logger.warning(f"Cache backend error reading version: {str(e)}")
+            return None
+
+    def get(self, key, version):
+        if version is None:
+            return None
+        try:
+            value = self.backend.get(self._key(key, version))
+        except Exception as e:
+            self._count('errors')
+            logger.warning(f"Cache backend error on get: {str(e)}")
+            return None
+        self._count('hits' if value is not None else 'misses')
+        return value
+
+    def set(self, key, value, version):
+        if version is None:
+            return
+        try:
+            self.backend.set(self._key(key, version), value, self.ttl)
+        except Exception as e:
+            self._count('errors')
+            logger.warning(f"Cache backend error on set: {str(e)}")
+
+    # Returns the new version, or None if the backend could not be reached
+    def invalidate(self):
+        try:
+            version = self.backend.incr(f"{self.namespace}:version")
+            self._count('invalidations')
+            return version
+        except Exception as e:
+            self._count('errors')
+            logger.error(f"Cache backend error on invalidate: {str(e)}")
+            return None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['version'] = self.current_version()
+        stats.update(self.backend.stats())
+        return stats
+
+catalog_cache = ResponseCache(
+    create_cache_backend(),
+    namespace='catalog',
+    ttl=app.config['CATALOG_CACHE_TTL']
+)
+
+def catalog_cache_key():
+    args = sorted(request.args.items(multi=True))
+    return request.path + '?' + '&'.join(f"{k}={v}" for k, v in args)
+
+# Cache entries are stored as "<etag>\n<last-modified>\n<body>" so validators
+# survive the round trip through any backend that only stores bytes
+def pack_cached_response(etag, last_modified, body):
+    return f"{etag}\n{last_modified or ''}\n".encode('utf-8') + body
+
+def unpack_cached_response(value):
+    etag, last_modified, body = value.split(b'\n', 2)
+    return etag.decode('utf-8'), last_modified.decode('utf-8') or None, body
+
+def compute_etag(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+# Only single-product responses set Last-Modified. A list's newest updated_at
+# does not move when a product is deleted, deactivated or gains image variants,
+# so lists are validated by ETag alone.
+def cached_response(max_age):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            key = catalog_cache_key()
+            # Entries are written under the version read here, so a response built
+            # while an invalidation lands is never served under the new version
+            version = catalog_cache.current_version()
+            cached = catalog_cache.get(key, version)
+            if cached is not None:
+                etag, last_modified, body = unpack_cached_response(cached)
+                response = app.response_class(body, status=200, mimetype='application/json')
+                if last_modified:
+                    response.headers['Last-Modified'] = last_modified
+            else:
+                response = app.make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                etag = compute_etag(body)
+                catalog_cache.set(
+                    key,
+                    pack_cached_response(etag, response.headers.get('Last-Modified'), body),
+                    version
+                )
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = f"public, max-age={max_age}"
+            return response.make_conditional(request)
+        return decorated_function
+    return decorator
+
+def invalidate_catalog_cache():
+    return catalog_cache.invalidate()
+
+# ========== NOTIFICATIONS ==========
+# In-process publish/subscribe used by the server-sent event streams. Each
+# subscriber gets its own bounded queue; slow consumers drop messages rather
+# than block the publisher.
+class NotificationBus:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, topic):
+        subscriber = queue.Queue(maxsize=100)
+        with self._lock:
+            self._subscribers.setdefault(topic, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, topic, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(topic)
+            if subscribers:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[topic]
+
+    def publish(self, topic, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(topic, ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'topics': len(self._subscribers),
+                'subscribers': sum(len(s) for s in self._subscribers.values())
+            }
+
+notification_bus = NotificationBus()
+
+def sse_event(data, event=None):
+    message = f"event: {event}\n" if event else ''
+    return message + f"data: {json.dumps(data, default=str)}\n\n"
+
+# Streams `render(message)` for every message published on `topic`, starting
+# with `initial`. `render` returning None skips the message; an event with
+# `final` set ends the stream. `on_idle`, if given, is polled at every
+# heartbeat to catch changes published by other processes.
+# The generator blocks its WSGI worker thread for the life of the stream (up to
+# SSE_MAX_DURATION), so a server needs a thread per open stream on top of the
+# threads serving ordinary requests: size gunicorn --threads (or use a gevent
+# worker) for the number of concurrently open carts and checkouts.
+def sse_response(topic, render, initial=None, on_idle=None):
+    subscriber = notification_bus.subscribe(topic)
+
+    def generate():
+        try:
+            if initial is not None:
+                yield sse_event(initial)
+                if initial.get('final'):
+                    return
+            deadline = time.monotonic() + app.config['SSE_MAX_DURATION']
+            while time.monotonic() < deadline:
+                try:
+                    message = subscriber.get(timeout=app.config['SSE_HEARTBEAT'])
+                except queue.Empty:
+                    data = on_idle() if on_idle else None
+                    if data is None:
+                        yield ": keep-alive\n\n"
+                        continue
+                else:
+                    data = render(message)
+                if data is not None:
+                    yield sse_event(data)
+                    if data.get('final'):
+                        return
+        finally:
+            notification_bus.unsubscribe(topic, subscriber)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# ========== AUTH CACHE ==========
+# Claims of already-verified JWTs, keyed by the token's SHA-256 digest. Each
+# entry lives until the token's own `exp`, so expiry is still enforced.
+class VerifiedTokenCache:
+    def __init__(self, max_entries):
+        self._entries = MemoryCacheBackend(max_entries=max_entries)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def get(self, digest):
+        data = self._entries.get(digest)
+        with self._lock:
+            self._stats['hits' if data is not None else 'misses'] += 1
+        return data
+
+    def put(self, digest, data):
+        ttl = data['exp'] - time.time() if 'exp' in data else app.config['AUTH_CACHE_MAX_TTL']
+        ttl = min(ttl, app.config['AUTH_CACHE_MAX_TTL'])
+        if ttl > 0:
+            self._entries.set(digest, data, ttl)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(self._entries.stats())
+        del stats['backend']
+        return stats
+
+verified_tokens = VerifiedTokenCache(app.config['AUTH_CACHE_MAX_ENTRIES'])
+
+# Ids of suspended users, reloaded from users.is_suspended in the background
+# every SUSPENSION_REFRESH_INTERVAL seconds. Admin changes made in this process
+# apply immediately.
+class SuspendedUsers:
+    def __init__(self):
+        self._ids = frozenset()
+        self._loaded_at = None
+        self._refresh_lock = threading.Lock()
+        self._stats = {'refreshes': 0, 'refresh_failures': 0, 'rejected': 0}
+
+    def _refresh(self):
+        try:
+            connection = get_db_connection()
+            with connection:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT id FROM users WHERE is_suspended = TRUE")
+                    self._ids = frozenset(row['id'] for row in cursor.fetchall())
+            self._stats['refreshes'] += 1
+        except Exception as e:
+            self._stats['refresh_failures'] += 1
+            logger.error(f"Could not refresh suspended users: {str(e)}")
+        # Failures also wait a full interval so a database outage is not hammered
+        self._loaded_at = time.monotonic()
+
+    def _refresh_in_background(self):
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+
+        def refresh():
+            try:
+                self._refresh()
+            finally:
+                self._refresh_lock.release()
+
+        threading.Thread(target=refresh, name="suspended-users-refresh", daemon=True).start()
+
+    def contains(self, user_id):
+        if self._loaded_at is None:
+            # The first lookup in a process waits for the initial load
+            with self._refresh_lock:
+                if self._loaded_at is None:
+                    self._refresh()
+        elif time.monotonic() - self._loaded_at > app.config['SUSPENSION_REFRESH_INTERVAL']:
+            self._refresh_in_background()
+
+        if user_id in self._ids:
+            self._stats['rejected'] += 1
+            return True
+        return False
+
+    def set_suspended(self, user_id, suspended):
+        ids = set(self._ids)
+        if suspended:
+            ids.add(user_id)
+        else:
+            ids.discard(user_id)
+        self._ids = frozenset(ids)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['suspended'] = len(self._ids)
+        return stats
+
+suspended_users = SuspendedUsers()
+
+# ========== RATE LIMITING ==========
+# Sliding-window counters: each key counts hits in fixed windows and the
+# estimate is the current window plus the previous one weighted by how much of
+# it still overlaps the sliding window. Two counters per key, no timestamp logs.
+class MemoryRateLimitStore:
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._windows = {}  # key -> [window index, current count, previous count, window]
+        self._lock = threading.Lock()
+
+    def hit(self, key, window):
+        now = time.time()
+        index = int(now // window)
+        with self._lock:
+            entry = self._windows.get(key)
+            if entry is None or entry[0] < index - 1:
+                entry = [index, 0, 0, window]
+            elif entry[0] == index - 1:
+                entry = [index, 0, entry[1], window]
+            entry[1] += 1
+            self._windows[key] = entry
+            if len(self._windows) > self.max_keys:
+                self._prune(now)
+            current, previous = entry[1], entry[2]
+        return current, previous, (now % window) / window
+
+    # Drops keys whose counters can no longer affect an estimate
+    def _prune(self, now):
+        stale = [key for key, entry in self._windows.items()
+                 if entry[0] < int(now // entry[3]) - 1]
+        for key in stale:
+            del self._windows[key]
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'keys': len(self._windows)}
+
+class RedisRateLimitStore:
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis requires the redis package")
+        self._client = redis.Redis.from_url(url)
+
+    def hit(self, key, window):
+        now = time.time()
+        index = int(now // window)
+        pipe = self._client.pipeline(transaction=True)
+        pipe.incr(f"{key}:{index}")
+        pipe.expire(f"{key}:{index}", window * 2)
+        pipe.get(f"{key}:{index - 1}")
+        current, _, previous = pipe.execute()
+        return int(current), int(previous or 0), (now % window) / window
+
+    def stats(self):
+        return {'backend': 'redis'}
+
+def create_rate_limit_store():
+    if app.config['RATE_LIMIT_BACKEND'] == 'redis':
+        return RedisRateLimitStore(app.config['CACHE_REDIS_URL'])
+    return MemoryRateLimitStore(max_keys=app.config['RATE_LIMIT_MAX_KEYS'])
+
+class RateLimiter:
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _count(self, name, outcome):
+        with self._lock:
+            counts = self._stats.setdefault(name, {'allowed': 0, 'rejected': 0, 'errors': 0})
+            counts[outcome] += 1
+
+    # Returns seconds to wait if any scope is over its limit, otherwise None.
+    # Store failures let the request through: an outage must not lock out logins.
+    def check(self, name, identities):
+        retry_after = None
+        for scope, identity in identities.items():
+            if not identity or scope not in app.config['RATE_LIMITS'][name]:
+                continue
+            limit, window = app.config['RATE_LIMITS'][name][scope]
+            digest = hashlib.sha256(identity.encode('utf-8')).hexdigest()[:32]
+            try:
+                current, previous, elapsed = self.store.hit(f"ratelimit:{name}:{scope}:{digest}", window)
+            except Exception as e:
+                self._count(f"{name}:{scope}", 'errors')
+                logger.warning(f"Rate limit store error: {str(e)}")
+                continue
+            if current + previous * (1 - elapsed) > limit:
+                self._count(f"{name}:{scope}", 'rejected')
+                wait = max(1, int(window * (1 - elapsed)) + 1)
+                retry_after = max(retry_after or 0, wait)
+            else:
+                self._count(f"{name}:{scope}", 'allowed')
+        return retry_after
+
+    def stats(self):
+        with self._lock:
+            scopes = {name: dict(counts) for name, counts in self._stats.items()}
+        stats = self.store.stats()
+        stats['scopes'] = scopes
+        return stats
+
+rate_limiter = RateLimiter(create_rate_limit_store())
+
+def rate_limited(name):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            email = (request.form.get('email') or '').strip().lower()
+            retry_after = rate_limiter.check(name, {'ip': request.remote_addr or '', 'email': email})
+            if retry_after is not None:
+                response = jsonify({"error": "Too many attempts, please try again later"})
+                response.headers['Retry-After'] = str(retry_after)
+                return response, 429
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+# ========== ACCESS LOG ==========
+@app.before_request
+def start_request_log():
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g.request_started = time.perf_counter()
+
+# Logs a sample of requests (plus every 5xx and slow one) as structured records
 @app.after_request
-def after_request_logging(response):
-    logger.info(f"Response: {response.status} {request.method} {request.path}")
-    logger.info(f"Response Headers: {response.headers}")
+def access_log(response):
+    response.headers['X-Request-ID'] = g.request_id
+    duration = (time.perf_counter() - g.request_started) * 1000
+    if not (response.status_code >= 500
+            or duration >= app.config['ACCESS_LOG_SLOW_MS']
+            or random.random() < app.config['ACCESS_LOG_SAMPLE_RATE']):
+        return response
+
+    fields = {
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'duration_ms': round(duration, 2),
+        'db_ms': round(g.get('db_time', 0.0) * 1000, 2),
+        'db_queries': g.get('db_queries', 0),
+        'bytes': response.content_length,
+        'remote_addr': request.remote_addr,
+        'user_id': getattr(request, 'user_id', None)
+    }
+    if app.debug or app.config['LOG_HEADERS']:
+        fields['request_headers'] = {
+            name: value for name, value in request.headers.items()
+            if name.lower() not in ('authorization', 'cookie')
+        }
+        fields['response_headers'] = dict(response.headers)
+    access_logger.info(f"{request.method} {request.path} {response.status_code}", extra={'fields': fields})
     return response
 
 # ========== AUTHENTICATION ENDPOINTS ==========
+# Password hashing can wait up to BCRYPT_TIMEOUT on the bcrypt pool, so these
+# handlers never hold a pooled DB connection across it: rows are read, the
+# connection goes back to the pool, and a fresh one is taken for the write.
 @app.route('/api/auth/register', methods=['POST'])
+@rate_limited('register')
 def register():
     try:
         data = request.form
@@ -173,7 +1238,11 @@ def register():
                 if cursor.fetchone():
                     return jsonify({"error": "User already exists"}), 400
 
-                password_hash = hash_password(data['password'])
+        password_hash = hash_password(data['password'])
+
+        connection = get_db_connection()
+        with connection:
+            with connection.cursor() as cursor:
                 sql = """INSERT INTO users (username, email, password_hash, first_name, last_name, phone, is_admin)
                          VALUES (%s, %s, %s, %s, %s, %s, %s)"""
                 cursor.execute(sql, (
@@ -195,10 +1264,16 @@ def register():
             "token": token
         }), 201
 
+    except HashingBusy:
+        return hashing_busy_response()
+    except pymysql.err.IntegrityError:
+        # Registered by a concurrent request while the password was hashed
+        return jsonify({"error": "User already exists"}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/auth/login', methods=['POST'])
+@rate_limited('login')
 def login():
     try:
         data = request.form
@@ -214,38 +1289,78 @@ def login():
                 cursor.execute("SELECT * FROM users WHERE email = %s", (email,))
                 user = cursor.fetchone()
 
-                if not user or not verify_password(password, user['password_hash']):
-                    return jsonify({"error": "Invalid credentials"}), 401
+        if not user or not verify_password(password, user['password_hash']):
+            return jsonify({"error": "Invalid credentials"}), 401
 
-                token = generate_token(user['id'], user.get('is_admin', False))
-                return jsonify({
-                    "message": "Login successful",
-                    "token": token,
-                    "user": {
-                        "id": user['id'],
-                        "username": user['username'],
-                        "email": user['email'],
-                        "first_name": user['first_name'],
-                        "is_admin": bool(user['is_admin'])
-                    }
-                })
+        # Move the stored hash to the configured cost while we have the plain password;
+        # the update is skipped if the password changed in the meantime
+        if password_needs_rehash(user['password_hash']):
+            try:
+                new_hash = hash_password(password)
+                connection = get_db_connection()
+                with connection:
+                    with connection.cursor() as cursor:
+                        cursor.execute(
+                            "UPDATE users SET password_hash = %s WHERE id = %s AND password_hash = %s",
+                            (new_hash, user['id'], user['password_hash'])
+                        )
+                    connection.commit()
+                password_hasher.count('rehashes')
+            except HashingBusy:
+                pass
 
+        token = generate_token(user['id'], user.get('is_admin', False))
+        return jsonify({
+            "message": "Login successful",
+            "token": token,
+            "user": {
+                "id": user['id'],
+                "username": user['username'],
+                "email": user['email'],
+                "first_name": user['first_name'],
+                "is_admin": bool(user['is_admin'])
+            }
+        })
+
+    except HashingBusy:
+        return hashing_busy_response()
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # ========== USER MANAGEMENT ENDPOINTS ==========
 @app.route('/api/users', methods=['GET'])
 def get_all_users():
+    try:
+        page = get_page_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     try:
         connection = get_db_connection()
         with connection:
             with connection.cursor() as cursor:
-                cursor.execute("""
-                    SELECT id, username, email, first_name, last_name,
-                           phone, is_admin, created_at
-                    FROM users
-                """)
+                sql = """
+                    SELECT u.id, u.username, u.email, u.first_name, u.last_name,
+                           u.phone, u.is_admin, u.created_at
+                    FROM users u
+                """
+                params = []
+
+                if page:
+                    page_size, after = page
+                    if after:
+                        condition, condition_params = keyset_condition('u', after)
+                        sql += f" WHERE {condition}"
+                        params.extend(condition_params)
+                    sql += " ORDER BY u.created_at DESC, u.id DESC LIMIT %s"
+                    params.append(page_size + 1)
+
+                cursor.execute(sql, params)
                 users = cursor.fetchall()
+
+        if page:
+            users, next_cursor = paginate_rows(users, page[0])
+            return jsonify({"items": users, "next_cursor": next_cursor})
         return jsonify(users)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -307,6 +1422,7 @@ def update_user(user_id):
                     user_id
                 ))
             connection.commit()
+        suspended_users.set_suspended(user_id, bool(data.get('is_suspended', False)))
         return jsonify({"message": "User updated successfully"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -434,16 +1550,7 @@ def upload_avatar():
         return jsonify({"error": "Allowed file types are: png, jpg, jpeg, gif"}), 400
 
     try:
-        ext = secure_filename(avatar.filename).split('.')[-1]
-        filename = f"avatar_{request.user_id}_{uuid.uuid4().hex}.{ext}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-        avatar.save(filepath)
-
-        avatar_url = f"/static/images/{filename}"
-
+        released = []
         connection = get_db_connection()
         with connection:
             with connection.cursor() as cursor:
@@ -453,26 +1560,29 @@ def upload_avatar():
                 )
                 old_avatar = cursor.fetchone()
 
-                if old_avatar and old_avatar['avatar_url']:
-                    try:
-                        old_path = os.path.join(app.config['UPLOAD_FOLDER'], old_avatar['avatar_url'].split('/')[-1])
-                        if os.path.exists(old_path):
-                            os.remove(old_path)
-                    except Exception as e:
-                        app.logger.error(f"Error deleting old avatar: {str(e)}")
+                # Store before releasing so re-uploading the same picture keeps its file
+                filename = store_blob(cursor, avatar)
+                avatar_url = f"/static/images/{filename}"
 
+                if old_avatar and old_avatar['avatar_url']:
+                    release_image(cursor, {'image_url': old_avatar['avatar_url']}, released)
                 cursor.execute(
                     "UPDATE users SET avatar_url = %s WHERE id = %s",
                     (avatar_url, request.user_id)
                 )
+                queue_image_job(cursor, 'avatar', request.user_id, filename)
 
             connection.commit()
+        unlink_released(released)
+        image_workers.notify()
 
         return jsonify({
             "message": "Avatar uploaded successfully",
             "avatar_url": avatar_url
         })
 
+    except InvalidUpload as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -506,29 +1616,132 @@ def change_password():
                     (user_id,))
                 user = cursor.fetchone()
 
-                if not user:
-                    return jsonify({"error": "User not found"}), 404
+        if not user:
+            return jsonify({"error": "User not found"}), 404
 
-                if not bcrypt.checkpw(
-                    current_password.encode('utf-8'),
-                    user['password_hash'].encode('utf-8')
-                ):
-                    return jsonify({"error": "Current password is incorrect"}), 401
+        if not verify_password(current_password, user['password_hash']):
+            return jsonify({"error": "Current password is incorrect"}), 401
 
-                new_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-                cursor.execute(
-                    "UPDATE users SET password_hash = %s WHERE id = %s",
-                    (new_hash, user_id)
-                )
+        new_hash = hash_password(new_password)
 
+        connection = get_db_connection()
+        with connection:
+            with connection.cursor() as cursor:
+                # Matches nothing if the password was changed while this one was hashed
+                updated = cursor.execute(
+                    "UPDATE users SET password_hash = %s WHERE id = %s AND password_hash = %s",
+                    (new_hash, user_id, user['password_hash'])
+                )
             connection.commit()
 
+        if not updated:
+            return jsonify({"error": "Password was changed by another request, please retry"}), 409
         return jsonify({"message": "Password updated successfully"})
 
+    except HashingBusy:
+        return hashing_busy_response()
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # ========== CART ENDPOINTS ==========
+# Badge-sized cart aggregate, cached per user and dropped by every cart write.
+# Only a shared (Redis) cache is used: a per-process cache would keep serving a
+# stale count in every worker except the one that handled the write, and the
+# aggregate is a single indexed query anyway.
+cart_summary_cache = create_cache_backend() if app.config['CACHE_BACKEND'] == 'redis' else None
+
+def get_cart_summary(user_id):
+    key = f"cart_summary:{user_id}"
+    if cart_summary_cache is not None:
+        try:
+            cached = cart_summary_cache.get(key)
+            if cached is not None:
+                return json.loads(cached)
+        except Exception as e:
+            logger.warning(f"Cart summary cache error: {str(e)}")
+
+    connection = get_db_connection()
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """SELECT COUNT(ci.id) AS item_count,
+                          COALESCE(SUM(ci.quantity), 0) AS quantity,
+                          COALESCE(SUM(p.price * ci.quantity), 0) AS subtotal
+                   FROM carts c
+                   JOIN cart_items ci ON ci.cart_id = c.id
+                   JOIN products p ON ci.product_id = p.id
+                   WHERE c.user_id = %s""",
+                (user_id,)
+            )
+            row = cursor.fetchone()
+
+    summary = {
+        "item_count": int(row['item_count']),
+        "quantity": int(row['quantity']),
+        "subtotal": str(row['subtotal'])
+    }
+    if cart_summary_cache is not None:
+        try:
+            cart_summary_cache.set(key, json.dumps(summary), app.config['CART_SUMMARY_TTL'])
+        except Exception as e:
+            logger.warning(f"Cart summary cache error: {str(e)}")
+    return summary
+
+# Called after every committed cart write
+def cart_changed(user_id):
+    if cart_summary_cache is not None:
+        try:
+            cart_summary_cache.delete(f"cart_summary:{user_id}")
+        except Exception as e:
+            logger.warning(f"Cart summary cache error: {str(e)}")
+    notification_bus.publish(f"cart:{user_id}", {"type": "cart_changed"})
+
+@app.route('/api/cart/summary', methods=['GET'])
+@token_required
+def cart_summary():
+    try:
+        return jsonify(get_cart_summary(request.user_id))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Server-sent events with the cart summary after each change. Writes in this
+# process arrive through the notification bus; writes handled by other
+# processes are picked up by re-reading the summary at every heartbeat.
+@app.route('/api/cart/events', methods=['GET'])
+def cart_events():
+    error = authenticate_stream_request()
+    if error:
+        return error
+
+    user_id = request.user_id
+    try:
+        initial = get_cart_summary(user_id)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    last_summary = [initial]
+
+    def render(message):
+        try:
+            last_summary[0] = get_cart_summary(user_id)
+        except Exception as e:
+            logger.error(f"Error refreshing cart summary: {str(e)}")
+            return None
+        return last_summary[0]
+
+    def on_idle():
+        try:
+            current = get_cart_summary(user_id)
+        except Exception as e:
+            logger.error(f"Error polling cart summary: {str(e)}")
+            return None
+        if current == last_summary[0]:
+            return None
+        last_summary[0] = current
+        return current
+
+    return sse_response(f"cart:{user_id}", render, initial, on_idle)
+
 @app.route('/api/cart/<int:item_id>', methods=['OPTIONS'])
 def handle_cart_options(item_id):
     return jsonify({}), 200
@@ -558,6 +1771,7 @@ def update_cart_item(item_id):
                     (quantity, item_id)
                 )
             connection.commit()
+        cart_changed(request.user_id)
 
         logger.info(f"Updated cart item {item_id} to quantity {quantity} for user {request.user_id}")
         return jsonify({"message": "Cart item updated successfully"})
@@ -598,6 +1812,7 @@ def remove_cart_item(item_id):
                 )
 
             connection.commit()
+        cart_changed(user_id)
 
         return jsonify({"message": "Cart item removed successfully"})
 
@@ -625,6 +1840,7 @@ def clear_cart():
                     (cart['id'],)
                 )
             connection.commit()
+        cart_changed(user_id)
         return jsonify({"message": "Cart cleared successfully"})
     except Exception as e:
         logger.error(f"Error clearing cart: {str(e)}")
@@ -648,27 +1864,162 @@ def get_cart():
                 if not cart:
                     return jsonify({"items": []})
 
+                cart_data = fetch_cart(cursor, cart['id'])
+
+        return jsonify(cart_data)
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def fetch_cart(cursor, cart_id):
+    cursor.execute(
+        """SELECT ci.*, p.name as product_name, p.price, pi.image_url as product_image,
+                  pi.variants as product_image_variants
+           FROM cart_items ci
+           JOIN products p ON ci.product_id = p.id
+           LEFT JOIN product_images pi ON p.id = pi.product_id AND pi.is_primary = TRUE
+           WHERE ci.cart_id = %s""",
+        (cart_id,)
+    )
+    items = cursor.fetchall()
+    for item in items:
+        variants = json.loads(item.pop('product_image_variants') or 'null')
+        item['product_thumb'] = variant_file(variants, 'thumb')
+
+    subtotal = sum(item['price'] * item['quantity'] for item in items)
+    total = subtotal
+
+    return {
+        "cart_id": cart_id,
+        "items": items,
+        "subtotal": subtotal,
+        "total": total
+    }
+
+# Parses the PATCH /api/cart body into (adds, updates, removes); raises ValueError on bad input
+def parse_cart_operations(operations):
+    if not isinstance(operations, list) or not operations:
+        raise ValueError("operations must be a non-empty list")
+    if len(operations) > app.config['MAX_CART_OPERATIONS']:
+        raise ValueError(f"At most {app.config['MAX_CART_OPERATIONS']} operations per request")
+
+    adds = {}
+    updates = {}
+    removes = set()
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise ValueError("Each operation must be an object")
+        op = operation.get('op')
+        try:
+            if op == 'add':
+                product_id = int(operation['product_id'])
+                quantity = int(operation.get('quantity', 1))
+                if quantity < 1:
+                    raise ValueError("Quantity must be at least 1")
+                adds[product_id] = adds.get(product_id, 0) + quantity
+            elif op == 'update':
+                item_id = int(operation['item_id'])
+                quantity = int(operation['quantity'])
+                if quantity < 1:
+                    raise ValueError("Quantity must be at least 1")
+                updates[item_id] = quantity
+            elif op == 'remove':
+                removes.add(int(operation['item_id']))
+            else:
+                raise ValueError(f"Unknown operation: {op}")
+        except (KeyError, TypeError):
+            raise ValueError(f"Malformed {op} operation")
+
+    # A line that is removed in the same batch needs no update
+    for item_id in removes:
+        updates.pop(item_id, None)
+    return adds, updates, removes
+
+# Applies a batch of add/update/remove operations in one transaction and returns the cart:
+# {"operations": [{"op": "add", "product_id": 3, "quantity": 2},
+#                 {"op": "update", "item_id": 10, "quantity": 1},
+#                 {"op": "remove", "item_id": 11}]}
+@app.route('/api/cart', methods=['PATCH'])
+@token_required
+def update_cart():
+    try:
+        data = request.get_json(silent=True) or {}
+        adds, updates, removes = parse_cart_operations(data.get('operations'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        user_id = request.user_id
+        connection = get_db_connection()
+        with connection:
+            with connection.cursor() as cursor:
                 cursor.execute(
-                    """SELECT ci.*, p.name as product_name, p.price, pi.image_url as product_image
-                       FROM cart_items ci
-                       JOIN products p ON ci.product_id = p.id
-                       LEFT JOIN product_images pi ON p.id = pi.product_id AND pi.is_primary = TRUE
-                       WHERE ci.cart_id = %s""",
-                    (cart['id'],)
+                    """INSERT INTO carts (user_id) VALUES (%s)
+                       ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)""",
+                    (user_id,)
                 )
-                items = cursor.fetchall()
+                cart_id = cursor.lastrowid
 
-                subtotal = sum(item['price'] * item['quantity'] for item in items)
-                total = subtotal
+                # One ownership check covers every item referenced by the batch
+                item_ids = set(updates) | removes
+                if item_ids:
+                    placeholders = ', '.join(['%s'] * len(item_ids))
+                    cursor.execute(
+                        f"SELECT id FROM cart_items WHERE cart_id = %s AND id IN ({placeholders})",
+                        [cart_id, *item_ids]
+                    )
+                    missing = item_ids - {row['id'] for row in cursor.fetchall()}
+                    if missing:
+                        connection.rollback()
+                        return jsonify({"error": "Cart items not found", "item_ids": sorted(missing)}), 404
 
-        return jsonify({
-            "cart_id": cart['id'],
-            "items": items,
-            "subtotal": subtotal,
-            "total": total
-        })
+                if removes:
+                    placeholders = ', '.join(['%s'] * len(removes))
+                    cursor.execute(
+                        f"DELETE FROM cart_items WHERE cart_id = %s AND id IN ({placeholders})",
+                        [cart_id, *removes]
+                    )
+
+                if updates:
+                    cases = ' '.join(['WHEN %s THEN %s'] * len(updates))
+                    placeholders = ', '.join(['%s'] * len(updates))
+                    params = [value for item in updates.items() for value in item]
+                    cursor.execute(
+                        f"""UPDATE cart_items SET quantity = CASE id {cases} END
+                            WHERE cart_id = %s AND id IN ({placeholders})""",
+                        [*params, cart_id, *updates]
+                    )
+
+                if adds:
+                    placeholders = ', '.join(['%s'] * len(adds))
+                    cursor.execute(
+                        f"SELECT id, price FROM products WHERE is_active = TRUE AND id IN ({placeholders})",
+                        list(adds)
+                    )
+                    prices = {row['id']: row['price'] for row in cursor.fetchall()}
+                    missing = set(adds) - set(prices)
+                    if missing:
+                        connection.rollback()
+                        return jsonify({"error": "Products not found", "product_ids": sorted(missing)}), 404
+
+                    # pymysql folds this into a single multi-row INSERT
+                    cursor.executemany(
+                        """INSERT INTO cart_items (cart_id, product_id, quantity, price)
+                           VALUES (%s, %s, %s, %s)
+                           ON DUPLICATE KEY UPDATE quantity = quantity + VALUES(quantity)""",
+                        [(cart_id, product_id, quantity, prices[product_id])
+                         for product_id, quantity in adds.items()]
+                    )
+
+                cart_data = fetch_cart(cursor, cart_id)
+
+            connection.commit()
+        cart_changed(user_id)
+
+        return jsonify(cart_data)
 
     except Exception as e:
+        logger.error(f"Error in update_cart: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/cart/add', methods=['POST'])
@@ -683,62 +2034,764 @@ def add_to_cart():
         if not product_id:
             return jsonify({"error": "Product ID required"}), 400
 
+        if quantity < 1:
+            return jsonify({"error": "Quantity must be at least 1"}), 400
+
         connection = get_db_connection()
         with connection:
             with connection.cursor() as cursor:
+                # Relies on the unique keys from migrations/002_cart_unique_keys.sql.
+                # LAST_INSERT_ID(id) makes lastrowid the cart id whether it was created or found.
                 cursor.execute(
-                    "SELECT id, price FROM products WHERE id = %s AND is_active = TRUE",
-                    (product_id,)
+                    """INSERT INTO carts (user_id) VALUES (%s)
+                       ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)""",
+                    (user_id,)
                 )
-                product = cursor.fetchone()
+                cart_id = cursor.lastrowid
 
-                if not product:
+                # The increment happens inside MySQL, so concurrent adds never lose updates
+                cursor.execute(
+                    """INSERT INTO cart_items (cart_id, product_id, quantity, price)
+                       SELECT %s, p.id, %s, p.price
+                       FROM products p
+                       WHERE p.id = %s AND p.is_active = TRUE
+                       ON DUPLICATE KEY UPDATE cart_items.quantity = cart_items.quantity + VALUES(quantity)""",
+                    (cart_id, quantity, product_id)
+                )
+                if cursor.rowcount == 0:
+                    connection.rollback()
                     return jsonify({"error": "Product not found"}), 404
 
+            connection.commit()
+        cart_changed(user_id)
+
+        return jsonify({"message": "Item added to cart successfully"})
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# ========== PRODUCT SUGGESTIONS ==========
+app.config['SUGGEST_MAX_LIMIT'] = 20
+
+class _TrieNode:
+    __slots__ = ('children', 'keys', 'top')
+
+    def __init__(self):
+        self.children = {}
+        self.keys = set()
+        self.top = None  # ranked keys memoized by SuggestionIndex, reset on change
+
+# Prefix trie mapping every prefix of every token to the keys that own the token
+class PrefixIndex:
+    def __init__(self):
+        self._root = _TrieNode()
+        self._tokens = {}
+
+    def add(self, key, tokens):
+        self.remove(key)
+        tokens = set(tokens)
+        self._tokens[key] = tokens
+        for token in tokens:
+            node = self._root
+            for char in token:
+                node = node.children.setdefault(char, _TrieNode())
+                node.keys.add(key)
+                node.top = None
+
+    def remove(self, key):
+        for token in self._tokens.pop(key, ()):
+            path = []
+            node = self._root
+            for char in token:
+                child = node.children.get(char)
+                if child is None:
+                    break
+                path.append((node, char, child))
+                node = child
+            for parent, char, child in reversed(path):
+                child.keys.discard(key)
+                child.top = None
+                if not child.keys and not child.children:
+                    del parent.children[char]
+
+    def find(self, prefix):
+        node = self._root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+def suggestion_tokens(*values):
+    tokens = set()
+    for value in values:
+        if value:
+            tokens.update(re.findall(r'\w+', str(value).lower()))
+    return tokens
+
+# Version counter for the suggestion index, kept apart from the catalog cache
+# version so writes that cannot change a suggestion (rendered image variants)
+# flush cached responses without forcing every worker to reload the index
+suggestion_versions = ResponseCache(catalog_cache.backend, namespace='suggestions')
+
+# In-memory typeahead over product names, SKUs and category names. The index
+# remembers the suggestion version it reflects; admin writes in this worker
+# patch it in place, and a version bump from any other worker triggers a reload.
+class SuggestionIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._index = None
+        self._entries = {}
+        self._version = None
+
+    def _load(self, version):
+        connection = get_db_connection()
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT id, name, sku, is_featured FROM products WHERE is_active = TRUE")
+                products = cursor.fetchall()
+                cursor.execute("SELECT id, name, slug FROM categories WHERE is_active = TRUE")
+                categories = cursor.fetchall()
+
+        index = PrefixIndex()
+        entries = {}
+        for category in categories:
+            key = ('category', category['id'])
+            entries[key] = self._category_entry(category)
+            index.add(key, suggestion_tokens(category['name']))
+        for product in products:
+            key = ('product', product['id'])
+            entries[key] = self._product_entry(product)
+            index.add(key, suggestion_tokens(product['name'], product.get('sku')))
+
+        self._index = index
+        self._entries = entries
+        self._version = version
+
+    @staticmethod
+    def _product_entry(product):
+        name = product['name']
+        return {
+            'suggestion': {'type': 'product', 'id': product['id'], 'name': name},
+            'rank': (1, not product.get('is_featured'), len(name), name.lower())
+        }
+
+    @staticmethod
+    def _category_entry(category):
+        name = category['name']
+        return {
+            'suggestion': {'type': 'category', 'id': category['id'], 'name': name, 'slug': category['slug']},
+            'rank': (0, False, len(name), name.lower())
+        }
+
+    def _ensure_current(self):
+        version = suggestion_versions.current_version()
+        if self._index is None or (version is not None and version != self._version):
+            self._load(version)
+
+    # Local writes advance the index version only when no other worker's write
+    # happened in between; otherwise the next lookup reloads from the database
+    def _advance(self, version):
+        if self._version is not None and version is not None and version == self._version + 1:
+            self._version = version
+
+    def _rank(self, key):
+        return self._entries[key]['rank']
+
+    def suggest(self, query, limit=10):
+        terms = re.findall(r'\w+', query.lower())
+        if not terms:
+            return []
+        with self._lock:
+            self._ensure_current()
+            nodes = [self._index.find(term) for term in terms]
+            if any(node is None for node in nodes):
+                return []
+
+            if len(nodes) == 1:
+                # Single-prefix lookups (every keystroke of a one-word query)
+                # reuse the node's ranked list until the node changes
+                node = nodes[0]
+                if node.top is None:
+                    node.top = heapq.nsmallest(app.config['SUGGEST_MAX_LIMIT'], node.keys, key=self._rank)
+                top = node.top[:limit]
+            else:
+                nodes.sort(key=lambda node: len(node.keys))
+                others = [node.keys for node in nodes[1:]]
+                candidates = (key for key in nodes[0].keys if all(key in keys for keys in others))
+                top = heapq.nsmallest(limit, candidates, key=self._rank)
+            return [self._entries[key]['suggestion'] for key in top]
+
+    def upsert_product(self, product, version):
+        with self._lock:
+            if self._index is None:
+                return
+            key = ('product', product['id'])
+            if product.get('is_active', True):
+                self._entries[key] = self._product_entry(product)
+                self._index.add(key, suggestion_tokens(product['name'], product.get('sku')))
+            else:
+                self._entries.pop(key, None)
+                self._index.remove(key)
+            self._advance(version)
+
+    def remove_product(self, product_id, version):
+        with self._lock:
+            if self._index is None:
+                return
+            key = ('product', product_id)
+            self._entries.pop(key, None)
+            self._index.remove(key)
+            self._advance(version)
+
+    def upsert_category(self, category, version):
+        with self._lock:
+            if self._index is None:
+                return
+            key = ('category', category['id'])
+            self._entries[key] = self._category_entry(category)
+            self._index.add(key, suggestion_tokens(category['name']))
+            self._advance(version)
+
+product_suggestions = SuggestionIndex()
+
+# ========== IMAGE STORAGE ==========
+# Uploads are stored once per distinct content as
+# UPLOAD_FOLDER/ab/cd/<sha256>.<ext>, and that relative path is what
+# product_images.image_url and users.avatar_url reference. image_blobs counts
+# the references; files (and their rendered variants, which share the hash
+# prefix) are unlinked only when the count reaches zero. Files uploaded before
+# this scheme have plain names, are not counted and are deleted directly.
+BLOB_NAME = re.compile(r'^[0-9a-f]{64}')
+
+class InvalidUpload(Exception):
+    pass
+
+# Leading bytes of each accepted image type and the extension it is stored under
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+]
+
+# Multipart file parts are written by werkzeug in chunks straight into a temp
+# file inside UPLOAD_FOLDER, hashed and sniffed as they arrive, so an upload
+# never sits in memory and store_blob only has to rename the file into place.
+# Once the leading bytes show a part is not an image the rest is discarded.
+class HashingUploadFile:
+    def __init__(self):
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        self.path = os.path.join(app.config['UPLOAD_FOLDER'], f".upload-{uuid.uuid4().hex}.tmp")
+        self._file = open(self.path, 'w+b')
+        self._hash = hashlib.sha256()
+        self._head = b''
+        self.size = 0
+        self.kind = None
+        self.rejected = False
+        self.moved = False
+
+    def write(self, chunk):
+        if self.kind is None and not self.rejected:
+            self._head += chunk[:16]
+            if len(self._head) >= 8:
+                self.kind = next((ext for magic, ext in IMAGE_SIGNATURES if self._head.startswith(magic)), None)
+                self.rejected = self.kind is None
+        if self.rejected:
+            return len(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        return self._file.write(chunk)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    # Moves the finished file to `target` with an atomic rename
+    def move_to(self, target):
+        self._file.close()
+        os.replace(self.path, target)
+        self.moved = True
+
+    def close(self):
+        self._file.close()
+        if not self.moved:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingUploadFile()
+
+app.request_class = UploadRequest
+
+def blob_hash(url):
+    match = BLOB_NAME.match(url.split('/')[-1])
+    return match.group(0) if match else None
+
+def blob_dir(digest):
+    return os.path.join(app.config['UPLOAD_FOLDER'], digest[:2], digest[2:4])
+
+# Stores an uploaded FileStorage and takes a reference on it; returns its path.
+# The image_blobs row stays locked until the caller commits, so a concurrent
+# release of the same content cannot unlink the file underneath this upload.
+def store_blob(cursor, upload):
+    stream = upload.stream
+    if stream.kind is None:
+        raise InvalidUpload(f"{upload.filename} is not a PNG, JPEG or GIF image")
+    digest = stream.hexdigest()
+    size = stream.size
+    path = f"{digest[:2]}/{digest[2:4]}/{digest}.{stream.kind}"
+
+    cursor.execute(
+        """INSERT INTO image_blobs (hash, path, size, refcount) VALUES (%s, %s, %s, 1)
+           ON DUPLICATE KEY UPDATE refcount = refcount + 1""",
+        (digest, path, size)
+    )
+    cursor.execute("SELECT path FROM image_blobs WHERE hash = %s", (digest,))
+    path = cursor.fetchone()['path']
+
+    target = os.path.join(app.config['UPLOAD_FOLDER'], path)
+    if os.path.exists(target):
+        blob_stats['deduplicated'] += 1
+        return path
+
+    os.makedirs(blob_dir(digest), exist_ok=True)
+    stream.move_to(target)
+    blob_stats['stored'] += 1
+    return path
+
+def unlink_blob_files(digest):
+    directory = blob_dir(digest)
+    try:
+        names = [name for name in os.listdir(directory) if name.startswith(digest)]
+    except FileNotFoundError:
+        return
+    for name in names:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            app.logger.error(f"Error deleting image file {name}: {str(e)}")
+
+# Drops one reference to an image. Nothing is deleted here: images whose files
+# may go are appended to `released`, and the caller passes that list to
+# unlink_released() after committing, so a rollback never leaves rows pointing
+# at missing files.
+def release_image(cursor, image, released):
+    digest = blob_hash(image['image_url'])
+    if digest is None:
+        released.append(image)
+        return
+
+    cursor.execute("SELECT refcount FROM image_blobs WHERE hash = %s FOR UPDATE", (digest,))
+    blob = cursor.fetchone()
+    if not blob:
+        return
+    if blob['refcount'] > 1:
+        cursor.execute("UPDATE image_blobs SET refcount = refcount - 1 WHERE hash = %s", (digest,))
+        return
+    cursor.execute("DELETE FROM image_blobs WHERE hash = %s", (digest,))
+    released.append(image)
+
+# The caller's change is already committed, so failures here only leave an
+# orphaned file behind and are logged rather than raised
+def unlink_released(released):
+    for image in released:
+        digest = blob_hash(image['image_url'])
+        try:
+            if digest is None:
+                remove_image_files(image)
+            else:
+                unlink_unreferenced_blob(digest)
+        except Exception as e:
+            logger.error(f"Could not remove released image {image['image_url']}: {str(e)}")
+
+# Unlinks a blob's files if no image_blobs row references it. The locking read
+# on the missing key holds a gap lock until commit, so an upload of the same
+# content waits, then finds the files gone and writes them again.
+def unlink_unreferenced_blob(digest):
+    connection = get_db_connection()
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM image_blobs WHERE hash = %s FOR UPDATE", (digest,))
+            if cursor.fetchone():
+                return
+            unlink_blob_files(digest)
+            blob_stats['unlinked'] += 1
+        connection.commit()
+
+# Cleans up variants rendered for an image that was replaced or deleted
+# meanwhile; blob variants stay while anything still references the blob
+def discard_variants(source, variants):
+    digest = blob_hash(source)
+    if digest is None:
+        remove_image_files({'variants': variants})
+        return
+    unlink_unreferenced_blob(digest)
+
+blob_stats = {'stored': 0, 'deduplicated': 0, 'unlinked': 0}
+
+# ========== IMAGE PROCESSING ==========
+# Uploads are stored as-is and an image_jobs row is queued in the same
+# transaction. Background workers then render resized, metadata-free variants
+# (thumb/card/detail in each of IMAGE_FORMATS) next to the original and record
+# them in product_images.variants as
+# {"thumb": {"width": 160, "height": 120, "avif": "<file>", "webp": "<file>"}, ...}.
+class ImageRejected(Exception):
+    pass
+
+def queue_image_job(cursor, kind, target_id, source):
+    cursor.execute(
+        "INSERT INTO image_jobs (kind, target_id, source) VALUES (%s, %s, %s)",
+        (kind, target_id, source)
+    )
+
+def decode_image_variants(image):
+    if isinstance(image.get('variants'), (str, bytes)):
+        image['variants'] = json.loads(image['variants'])
+    return image
+
+# Picks the file most browsers can show for <img src>; AVIF needs <picture>
+def variant_file(variants, name):
+    variant = (variants or {}).get(name)
+    if not variant:
+        return None
+    return variant.get('webp') or next(
+        (variant[fmt] for fmt in app.config['IMAGE_FORMATS'] if fmt in variant), None)
+
+# Deletes an image's original and every rendered variant
+def remove_image_files(image):
+    variants = image.get('variants')
+    if isinstance(variants, (str, bytes)):
+        variants = json.loads(variants)
+    filenames = [image['image_url'].split('/')[-1]] if image.get('image_url') else []
+    for variant in (variants or {}).values():
+        filenames.extend(variant[fmt] for fmt in variant if fmt not in ('width', 'height'))
+
+    for filename in filenames:
+        try:
+            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            app.logger.error(f"Error deleting image file {filename}: {str(e)}")
+
+def supported_image_formats():
+    if Image is None:
+        return []
+    Image.init()
+    return [fmt for fmt in app.config['IMAGE_FORMATS'] if fmt.upper() in Image.SAVE]
+
+# Renders `sizes` ({name: longest edge}) of an uploaded file in each format.
+# Variants are resized from largest to smallest off a single decode, and files
+# are written under a temporary name and renamed so readers never see a partial
+# image. Returns (variants, bytes written).
+def render_image_variants(source, sizes, formats):
+    folder = app.config['UPLOAD_FOLDER']
+    stem = os.path.splitext(source)[0]
+    with Image.open(os.path.join(folder, source)) as original:
+        if original.width * original.height > app.config['IMAGE_MAX_PIXELS']:
+            raise ImageRejected(f"Image is {original.width}x{original.height}, too large to process")
+        # JPEGs decode straight at a reduced scale, far cheaper than a full decode + resize
+        original.draft('RGB', (max(sizes.values()), max(sizes.values())))
+        image = ImageOps.exif_transpose(original)
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+    # Drop EXIF, ICC and comments so they are not copied into the variants
+    image.info = {}
+
+    variants = {}
+    written = []
+    try:
+        for name, edge in sorted(sizes.items(), key=lambda item: -item[1]):
+            image.thumbnail((edge, edge), Image.LANCZOS)
+            variant = {'width': image.width, 'height': image.height}
+            for fmt in formats:
+                filename = f"{stem}_{name}.{fmt}"
+                path = os.path.join(folder, filename)
+                temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                image.save(temp_path, format=fmt.upper(), quality=app.config['IMAGE_QUALITY'].get(fmt, 80))
+                os.replace(temp_path, path)
+                written.append(path)
+                variant[fmt] = filename
+            variants[name] = variant
+    except Exception:
+        for path in written:
+            os.remove(path)
+        raise
+    return variants, sum(os.path.getsize(path) for path in written)
+
+class ImageWorkerPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self.formats = []
+        self._stale = False
+        self._invalidated_at = 0.0
+        self._stats = {
+            'claimed': 0, 'processed': 0, 'retried': 0, 'failed': 0, 'errors': 0,
+            'invalidations': 0, 'source_bytes': 0, 'variant_bytes': 0
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    # Threads do not survive a fork, so (re)start them once per process
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.formats = supported_image_formats()
+            if not self.formats:
+                logger.warning("Image processing disabled: Pillow is missing or cannot encode IMAGE_FORMATS")
+                return
+            for i in range(app.config['IMAGE_WORKERS']):
+                threading.Thread(target=self._run, name=f"image-worker-{i}", daemon=True).start()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                self._count('errors')
+                logger.error(f"Image worker failed to claim a job: {str(e)}")
+                job = None
+
+            if job is None:
+                self._invalidate_catalog(drained=True)
+                self._wakeup.wait(app.config['IMAGE_POLL_INTERVAL'])
+                self._wakeup.clear()
+                continue
+
+            try:
+                self._process(job)
+            except (ImageRejected, Image.UnidentifiedImageError, Image.DecompressionBombError, FileNotFoundError) as e:
+                self._fail(job, str(e), retryable=False)
+            except Exception as e:
+                self._count('errors')
+                logger.error(f"Image worker failed on job {job['id']}: {str(e)}")
+                self._fail(job, str(e), retryable=True)
+            self._invalidate_catalog(drained=False)
+
+    # Rendered variants change cached product responses, but a backfill would
+    # flush the cache once per image. Flushes are coalesced: at most one per
+    # IMAGE_INVALIDATE_INTERVAL while jobs keep coming, and one once the queue drains.
+    def _invalidate_catalog(self, drained):
+        with self._lock:
+            if not self._stale:
+                return
+            if not drained and time.monotonic() - self._invalidated_at < app.config['IMAGE_INVALIDATE_INTERVAL']:
+                return
+            self._stale = False
+            self._invalidated_at = time.monotonic()
+        invalidate_catalog_cache()
+        self._count('invalidations')
+
+    def _claim(self):
+        connection = get_db_connection()
+        with connection:
+            with connection.cursor() as cursor:
                 cursor.execute(
-                    "SELECT id FROM carts WHERE user_id = %s",
-                    (user_id,)
+                    """SELECT id, kind, target_id, source, attempts
+                       FROM image_jobs
+                       WHERE (status = 'queued' AND next_attempt_at <= NOW())
+                          OR (status = 'processing' AND locked_until < NOW())
+                       ORDER BY next_attempt_at
+                       LIMIT 1
+                       FOR UPDATE SKIP LOCKED"""
                 )
-                cart = cursor.fetchone()
+                job = cursor.fetchone()
+                if not job:
+                    return None
 
-                if not cart:
-                    cursor.execute(
-                        "INSERT INTO carts (user_id) VALUES (%s)",
-                        (user_id,)
+                cursor.execute(
+                    """UPDATE image_jobs
+                       SET status = 'processing', attempts = attempts + 1,
+                           locked_until = NOW() + INTERVAL %s SECOND
+                       WHERE id = %s""",
+                    (app.config['IMAGE_LEASE'], job['id'])
+                )
+            connection.commit()
+
+        job['attempts'] += 1
+        self._count('claimed')
+        return job
+
+    def _process(self, job):
+        source = job['source']
+        source_bytes = os.path.getsize(os.path.join(app.config['UPLOAD_FOLDER'], source))
+        # Avatars get a single WebP variant, which every browser can show in <img>
+        avatar_format = 'webp' if 'webp' in self.formats else self.formats[0]
+        if job['kind'] == 'avatar':
+            variants, written = render_image_variants(
+                source, {'avatar': app.config['AVATAR_SIZE']}, [avatar_format])
+        else:
+            # Another upload of the same blob may already have been rendered
+            variants, written = self._existing_variants(source), 0
+            if variants is None:
+                variants, written = render_image_variants(
+                    source, app.config['IMAGE_VARIANTS'], self.formats)
+
+        connection = get_db_connection()
+        with connection:
+            with connection.cursor() as cursor:
+                # The conditional updates match nothing if the image was replaced
+                # or deleted while it was being processed
+                if job['kind'] == 'avatar':
+                    avatar_file = variants['avatar'][avatar_format]
+                    applied = cursor.execute(
+                        "UPDATE users SET avatar_url = %s WHERE id = %s AND avatar_url = %s",
+                        (f"/static/images/{avatar_file}", job['target_id'], f"/static/images/{job['source']}")
                     )
-                    cart_id = cursor.lastrowid
                 else:
-                    cart_id = cart['id']
+                    applied = cursor.execute(
+                        "UPDATE product_images SET variants = %s WHERE id = %s AND image_url = %s",
+                        (json.dumps(variants), job['target_id'], job['source'])
+                    )
+                cursor.execute(
+                    """UPDATE image_jobs
+                       SET status = 'done', locked_until = NULL, last_error = NULL
+                       WHERE id = %s""",
+                    (job['id'],)
+                )
+            connection.commit()
 
+        if not applied:
+            discard_variants(source, variants)
+        elif job['kind'] == 'product_image':
+            with self._lock:
+                self._stale = True
+        self._count('processed')
+        self._count('source_bytes', source_bytes)
+        self._count('variant_bytes', written)
+
+    def _existing_variants(self, source):
+        if not blob_hash(source):
+            return None
+        connection = get_db_connection()
+        with connection:
+            with connection.cursor() as cursor:
                 cursor.execute(
-                    "SELECT id, quantity FROM cart_items WHERE cart_id = %s AND product_id = %s",
-                    (cart_id, product_id)
+                    "SELECT variants FROM product_images WHERE image_url = %s AND variants IS NOT NULL LIMIT 1",
+                    (source,)
                 )
-                existing_item = cursor.fetchone()
+                row = cursor.fetchone()
+        return decode_image_variants(row)['variants'] if row else None
 
-                if existing_item:
-                    new_quantity = existing_item['quantity'] + quantity
+    def _fail(self, job, error, retryable):
+        will_retry = retryable and job['attempts'] < app.config['IMAGE_MAX_ATTEMPTS']
+        connection = get_db_connection()
+        with connection:
+            with connection.cursor() as cursor:
+                if will_retry:
                     cursor.execute(
-                        "UPDATE cart_items SET quantity = %s WHERE id = %s",
-                        (new_quantity, existing_item['id'])
+                        """UPDATE image_jobs
+                           SET status = 'queued', last_error = %s, locked_until = NULL,
+                               next_attempt_at = NOW() + INTERVAL %s SECOND
+                           WHERE id = %s""",
+                        (error[:255], 30 * 2 ** (job['attempts'] - 1), job['id'])
                     )
+                    self._count('retried')
                 else:
                     cursor.execute(
-                        """INSERT INTO cart_items (cart_id, product_id, quantity, price)
-                           VALUES (%s, %s, %s, %s)""",
-                        (cart_id, product_id, quantity, product['price'])
+                        """UPDATE image_jobs
+                           SET status = 'failed', last_error = %s, locked_until = NULL
+                           WHERE id = %s""",
+                        (error[:255], job['id'])
                     )
-
+                    self._count('failed')
             connection.commit()
+        logger.warning(f"Image job {job['id']} for {job['source']} failed (attempt {job['attempts']}): {error}")
 
-        return jsonify({"message": "Item added to cart successfully"})
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['workers'] = app.config['IMAGE_WORKERS']
+        stats['formats'] = self.formats
+        return stats
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+image_workers = ImageWorkerPool()
 
 # ========== PRODUCT ENDPOINTS ==========
+# Product search uses the FULLTEXT index from migrations/001_products_fulltext.sql.
+# Whether the index exists, and the server's minimum indexed token length, are
+# checked once per process; without the index search falls back to LIKE matching.
+_fulltext_index_available = None
+_fulltext_min_token_size = 3
+
+def has_fulltext_index(cursor):
+    global _fulltext_index_available, _fulltext_min_token_size
+    if _fulltext_index_available is None:
+        cursor.execute("SHOW INDEX FROM products WHERE Index_type = 'FULLTEXT'")
+        columns = {row['Column_name'] for row in cursor.fetchall()}
+        if {'name', 'description'} <= columns:
+            cursor.execute("SELECT @@innodb_ft_min_token_size AS size")
+            _fulltext_min_token_size = int(cursor.fetchone()['size'])
+        _fulltext_index_available = {'name', 'description'} <= columns
+        if not _fulltext_index_available:
+            logger.warning("products FULLTEXT index missing, search falls back to LIKE")
+    return _fulltext_index_available
+
+# InnoDB's default stopword list; these words are never indexed
+FULLTEXT_STOPWORDS = frozenset((
+    'a', 'about', 'an', 'are', 'as', 'at', 'be', 'by', 'com', 'de', 'en', 'for', 'from',
+    'how', 'i', 'in', 'is', 'it', 'la', 'of', 'on', 'or', 'that', 'the', 'this', 'to',
+    'was', 'what', 'when', 'where', 'who', 'will', 'with', 'und', 'www'
+))
+
+# Turns free text into a boolean-mode query where every word is a required
+# prefix, e.g. "red hood" -> "+red* +hood*", which also serves typeahead.
+# Words the index never holds (shorter than the minimum token size, or
+# stopwords) could never match, so they are dropped: "T-Shirt for men" ->
+# "+Shirt* +men*". Returns '' when no indexable word is left.
+def fulltext_query(search, max_terms=8, min_token_size=3):
+    terms = [
+        term for term in re.findall(r'\w+', search)
+        if len(term) >= min_token_size and term.lower() not in FULLTEXT_STOPWORDS
+    ][:max_terms]
+    return ' '.join(f"+{term}*" for term in terms)
+
+# Fetch images for many products in one round trip, grouped by product id
+def fetch_product_images(cursor, product_ids):
+    images_by_product = {}
+    if not product_ids:
+        return images_by_product
+
+    placeholders = ', '.join(['%s'] * len(product_ids))
+    cursor.execute(f"""
+        SELECT product_id, image_url, is_primary, sort_order, variants
+        FROM product_images
+        WHERE product_id IN ({placeholders})
+        ORDER BY product_id, is_primary DESC, sort_order ASC
+    """, list(product_ids))
+
+    for image in cursor.fetchall():
+        product_id = image.pop('product_id')
+        images_by_product.setdefault(product_id, []).append(decode_image_variants(image))
+    return images_by_product
+
 @app.route('/api/products', methods=['GET'])
+@cached_response(max_age=app.config['PRODUCTS_MAX_AGE'])
 def get_products():
+    try:
+        page = get_page_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     try:
         category_id = request.args.get('category_id')
         featured = request.args.get('featured', '').lower() == 'true'
@@ -761,38 +2814,77 @@ def get_products():
                 if featured:
                     sql += " AND p.is_featured = TRUE"
 
-                if search:
-                    sql += " AND (p.name LIKE %s OR p.description LIKE %s)"
-                    params.extend([f"%{search}%", f"%{search}%"])
-
-                sql += " ORDER BY p.created_at DESC"
+                order_by = " ORDER BY p.created_at DESC, p.id DESC"
+                order_params = []
 
-                if limit and limit.isdigit():
+                if search:
+                    search_query = None
+                    if has_fulltext_index(cursor):
+                        search_query = fulltext_query(search, min_token_size=_fulltext_min_token_size)
+                    if search_query:
+                        sql += " AND MATCH(p.name, p.description) AGAINST (%s IN BOOLEAN MODE)"
+                        params.append(search_query)
+                        # Rank by relevance unless paging, where the keyset order must stay stable
+                        if not page:
+                            order_by = " ORDER BY MATCH(p.name, p.description) AGAINST (%s IN BOOLEAN MODE) DESC, p.created_at DESC, p.id DESC"
+                            order_params.append(search_query)
+                    else:
+                        sql += " AND (p.name LIKE %s OR p.description LIKE %s)"
+                        params.extend([f"%{search}%", f"%{search}%"])
+
+                if page:
+                    page_size, after = page
+                    if after:
+                        condition, condition_params = keyset_condition('p', after)
+                        sql += f" AND {condition}"
+                        params.extend(condition_params)
+
+                sql += order_by
+                params.extend(order_params)
+
+                if page:
+                    sql += " LIMIT %s"
+                    params.append(page_size + 1)
+                elif limit and limit.isdigit():
                     sql += " LIMIT %s"
                     params.append(int(limit))
 
                 cursor.execute(sql, params)
                 products = cursor.fetchall()
 
+                next_cursor = None
+                if page:
+                    products, next_cursor = paginate_rows(products, page_size)
+
                 products = [dict(p) for p in products]
 
+                images_by_product = fetch_product_images(cursor, [p['id'] for p in products])
                 for product in products:
-                    product_id = product['id']
-                    with connection.cursor() as img_cursor:
-                        img_cursor.execute("""
-                            SELECT image_url, is_primary, sort_order
-                            FROM product_images
-                            WHERE product_id = %s
-                            ORDER BY is_primary DESC, sort_order ASC
-                        """, (product_id,))
-                        images = img_cursor.fetchall()
-                        product['images'] = [dict(img) for img in images]
+                    product['images'] = images_by_product.get(product['id'], [])
 
+        if page:
+            return jsonify({"items": products, "next_cursor": next_cursor})
         return jsonify(products)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/products/suggest', methods=['GET'])
+def suggest_products():
+    query = request.args.get('q', '').strip()
+    limit = request.args.get('limit', '10')
+    limit = min(int(limit), app.config['SUGGEST_MAX_LIMIT']) if limit.isdigit() and int(limit) > 0 else 10
+
+    if not query:
+        return jsonify({"query": query, "suggestions": []})
+
+    try:
+        suggestions = product_suggestions.suggest(query, limit)
+        return jsonify({"query": query, "suggestions": suggestions})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/products/<int:product_id>', methods=['GET'])
+@cached_response(max_age=app.config['PRODUCTS_MAX_AGE'])
 def get_product(product_id):
     try:
         connection = get_db_connection()
@@ -815,9 +2907,11 @@ def get_product(product_id):
                     (product_id,)
                 )
                 images = cursor.fetchall()
-                product['images'] = images
+                product['images'] = [decode_image_variants(image) for image in images]
 
-        return jsonify(product)
+        response = jsonify(product)
+        response.last_modified = product.get('updated_at')
+        return response
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -841,10 +2935,6 @@ def create_product():
         if not allowed_file(main_image.filename):
             return jsonify({"error": "Invalid file type"}), 400
 
-        filename = secure_filename(main_image.filename)
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        main_image.save(image_path)
-
         connection = get_db_connection()
         with connection:
             with connection.cursor() as cursor:
@@ -874,19 +2964,19 @@ def create_product():
                 )
                 product_id = cursor.lastrowid
 
+                filename = store_blob(cursor, main_image)
                 cursor.execute(
                     """INSERT INTO product_images (
                         product_id, image_url, is_primary
                        ) VALUES (%s, %s, %s)""",
                     (product_id, filename, True)
                 )
+                queue_image_job(cursor, 'product_image', cursor.lastrowid, filename)
 
                 if 'additional_images' in files:
                     for img in files.getlist('additional_images'):
                         if allowed_file(img.filename):
-                            filename = secure_filename(img.filename)
-                            image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                            img.save(image_path)
+                            filename = store_blob(cursor, img)
 
                             cursor.execute(
                                 """INSERT INTO product_images (
@@ -894,14 +2984,27 @@ def create_product():
                                    ) VALUES (%s, %s, %s)""",
                                 (product_id, filename, False)
                             )
+                            queue_image_job(cursor, 'product_image', cursor.lastrowid, filename)
 
             connection.commit()
+        image_workers.notify()
+        invalidate_catalog_cache()
+        version = suggestion_versions.invalidate()
+        product_suggestions.upsert_product({
+            'id': product_id,
+            'name': data['name'],
+            'sku': data.get('sku', ''),
+            'is_featured': bool(data.get('is_featured', False)),
+            'is_active': bool(data.get('is_active', True))
+        }, version)
 
         return jsonify({
             "message": "Product created successfully",
             "product_id": product_id
         }), 201
 
+    except InvalidUpload as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -913,6 +3016,7 @@ def update_product(product_id):
         data = request.form
         files = request.files
 
+        released = []
         connection = get_db_connection()
         with connection:
             with connection.cursor() as cursor:
@@ -959,15 +3063,12 @@ def update_product(product_id):
                     images_to_delete = request.form.getlist('images_to_delete[]')
                     for image_id in images_to_delete:
                         cursor.execute(
-                            "SELECT image_url FROM product_images WHERE id = %s",
+                            "SELECT image_url, variants FROM product_images WHERE id = %s",
                             (image_id,)
                         )
                         image = cursor.fetchone()
                         if image:
-                            try:
-                                os.remove(os.path.join(app.config['UPLOAD_FOLDER'], image['image_url'].split('/')[-1]))
-                            except Exception as e:
-                                app.logger.error(f"Error deleting image file: {str(e)}")
+                            release_image(cursor, image, released)
 
                         cursor.execute(
                             "DELETE FROM product_images WHERE id = %s",
@@ -978,24 +3079,19 @@ def update_product(product_id):
                     main_image = files['main_image']
                     if allowed_file(main_image.filename):
                         cursor.execute(
-                            "SELECT id, image_url FROM product_images WHERE product_id = %s AND is_primary = TRUE",
+                            "SELECT id, image_url, variants FROM product_images WHERE product_id = %s AND is_primary = TRUE",
                             (product_id,)
                         )
                         old_main = cursor.fetchone()
                         if old_main:
-                            try:
-                                os.remove(os.path.join(app.config['UPLOAD_FOLDER'], old_main['image_url'].split('/')[-1]))
-                            except Exception as e:
-                                app.logger.error(f"Error deleting old main image: {str(e)}")
+                            release_image(cursor, old_main, released)
 
                             cursor.execute(
                                 "DELETE FROM product_images WHERE id = %s",
                                 (old_main['id'],)
                             )
 
-                        filename = secure_filename(main_image.filename)
-                        image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                        main_image.save(image_path)
+                        filename = store_blob(cursor, main_image)
 
                         cursor.execute(
                             """INSERT INTO product_images (
@@ -1003,13 +3099,12 @@ def update_product(product_id):
                                ) VALUES (%s, %s, %s)""",
                             (product_id, filename, True)
                         )
+                        queue_image_job(cursor, 'product_image', cursor.lastrowid, filename)
 
                 if 'additional_images' in files:
                     for img in files.getlist('additional_images'):
                         if allowed_file(img.filename):
-                            filename = secure_filename(img.filename)
-                            image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                            img.save(image_path)
+                            filename = store_blob(cursor, img)
 
                             cursor.execute(
                                 """INSERT INTO product_images (
@@ -1017,11 +3112,25 @@ def update_product(product_id):
                                    ) VALUES (%s, %s, %s)""",
                                 (product_id, filename, False)
                             )
+                            queue_image_job(cursor, 'product_image', cursor.lastrowid, filename)
 
             connection.commit()
+        unlink_released(released)
+        image_workers.notify()
+        invalidate_catalog_cache()
+        version = suggestion_versions.invalidate()
+        product_suggestions.upsert_product({
+            'id': product_id,
+            'name': data['name'],
+            'sku': data.get('sku', ''),
+            'is_featured': bool(data.get('is_featured', False)),
+            'is_active': bool(data.get('is_active', True))
+        }, version)
 
         return jsonify({"message": "Product updated successfully"})
 
+    except InvalidUpload as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -1029,24 +3138,50 @@ def update_product(product_id):
 @token_required
 @admin_required
 def get_orders():
+    try:
+        page = get_page_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     try:
         connection = get_db_connection()
         with connection:
             with connection.cursor() as cursor:
-                cursor.execute("""
+                sql = """
                     SELECT o.id, o.order_number, o.status, o.total_amount,
                            o.created_at, u.username, u.email
                     FROM orders o
                     JOIN users u ON o.user_id = u.id
-                    ORDER BY o.created_at DESC
-                """)
+                """
+                params = []
+
+                if page:
+                    page_size, after = page
+                    if after:
+                        condition, condition_params = keyset_condition('o', after)
+                        sql += f" WHERE {condition}"
+                        params.extend(condition_params)
+
+                sql += " ORDER BY o.created_at DESC, o.id DESC"
+
+                if page:
+                    sql += " LIMIT %s"
+                    params.append(page_size + 1)
+
+                cursor.execute(sql, params)
                 orders = cursor.fetchall()
 
+                next_cursor = None
+                if page:
+                    orders, next_cursor = paginate_rows(orders, page_size)
+
                 # Convert datetime objects to strings
                 for order in orders:
                     if order['created_at']:
                         order['created_at'] = order['created_at'].isoformat()
 
+        if page:
+            return jsonify({"items": orders, "next_cursor": next_cursor})
         return jsonify(orders)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -1109,6 +3244,7 @@ def get_order_details(order_id):
 @admin_required
 def delete_product(product_id):
     try:
+        released = []
         connection = get_db_connection()
         with connection:
             with connection.cursor() as cursor:
@@ -1117,41 +3253,129 @@ def delete_product(product_id):
                 if not product:
                     return jsonify({"error": "Product not found"}), 404
 
-                cursor.execute("SELECT image_url FROM product_images WHERE product_id = %s", (product_id,))
+                cursor.execute("SELECT image_url, variants FROM product_images WHERE product_id = %s", (product_id,))
                 images = cursor.fetchall()
 
                 for image in images:
-                    image_path = os.path.join(app.config['UPLOAD_FOLDER'], image['image_url'].split('/')[-1])
-                    try:
-                        if os.path.exists(image_path):
-                            os.remove(image_path)
-                    except Exception as e:
-                        app.logger.error(f"Error deleting image {image_path}: {str(e)}")
+                    release_image(cursor, image, released)
 
                 cursor.execute("DELETE FROM product_images WHERE product_id = %s", (product_id,))
                 cursor.execute("DELETE FROM products WHERE id = %s", (product_id,))
 
             connection.commit()
+        unlink_released(released)
+        invalidate_catalog_cache()
+        version = suggestion_versions.invalidate()
+        product_suggestions.remove_product(product_id, version)
 
         return jsonify({"message": "Product deleted successfully"})
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/static/images/<filename>')
+# ========== IMAGE SERVING ==========
+# Size and mtime of served files, so repeat requests (and every 304) skip the
+# filesystem. Deleted files are noticed when opening them fails, or after
+# STATIC_STAT_TTL in sendfile modes where the front-end server opens them.
+class StaticFileCache:
+    def __init__(self, max_entries, ttl):
+        self.ttl = ttl
+        self._entries = MemoryCacheBackend(max_entries=max_entries)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'not_modified': 0}
+
+    def count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    # Returns (size, modified datetime), or None if the file does not exist
+    def stat(self, path):
+        info = self._entries.get(path)
+        if info is not None:
+            self.count('hits')
+            return info
+        self.count('misses')
+        try:
+            stat = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        info = (stat.st_size, datetime.datetime.fromtimestamp(int(stat.st_mtime), datetime.timezone.utc))
+        self._entries.set(path, info, self.ttl)
+        return info
+
+    def forget(self, path):
+        self._entries.delete(path)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['entries'] = self._entries.stats()['entries']
+        return stats
+
+static_files = StaticFileCache(app.config['STATIC_STAT_MAX_ENTRIES'], app.config['STATIC_STAT_TTL'])
+
+def image_cache_headers(response, filename, etag, mtime):
+    response.set_etag(etag)
+    response.last_modified = mtime
+    # Set as a plain header; the cache_control accessor re-parses it on every use
+    if blob_hash(filename):
+        response.headers['Cache-Control'] = f"public, max-age={app.config['STATIC_IMMUTABLE_MAX_AGE']}, immutable"
+    else:
+        response.headers['Cache-Control'] = f"public, max-age={app.config['STATIC_MAX_AGE']}"
+    return response
+
+# The body goes out through wsgi.file_wrapper (sendfile under gunicorn/uWSGI),
+# or is handed to the front-end server with X-Sendfile / X-Accel-Redirect.
+# Revalidations are answered from the stat cache without opening the file.
+@app.route('/static/images/<path:filename>')
 def serve_image(filename):
-    if '..' in filename or filename.startswith('/'):
+    path = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    # Dot-files include in-flight uploads
+    if path is None or any(part.startswith('.') for part in filename.split('/')):
         return jsonify({"error": "Invalid filename"}), 400
 
-    image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    info = static_files.stat(path)
+    if info is None:
+        return jsonify({"error": "Image not found"}), 404
+    size, mtime = info
+
+    # Hashed names identify their content, so the name itself is a strong validator
+    digest = blob_hash(filename)
+    etag = os.path.basename(filename).rsplit('.', 1)[0] if digest else f"{int(mtime.timestamp())}-{size}"
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=mtime):
+        static_files.count('not_modified')
+        return image_cache_headers(Response(status=304), filename, etag, mtime)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    mode = app.config['STATIC_SENDFILE']
+    if mode == 'x-accel-redirect':
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = app.config['STATIC_ACCEL_PREFIX'] + filename
+        return image_cache_headers(response, filename, etag, mtime)
+    if mode == 'x-sendfile':
+        response = Response(mimetype=mimetype)
+        response.headers['X-Sendfile'] = path
+        return image_cache_headers(response, filename, etag, mtime)
 
-    if not os.path.exists(image_path):
+    try:
+        file = open(path, 'rb')
+    except FileNotFoundError:
+        static_files.forget(path)
         return jsonify({"error": "Image not found"}), 404
 
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    response = Response(wrap_file(request.environ, file), mimetype=mimetype, direct_passthrough=True)
+    response.content_length = size
+    image_cache_headers(response, filename, etag, mtime)
+    try:
+        return response.make_conditional(request.environ, accept_ranges=True, complete_length=size)
+    except Exception:
+        file.close()
+        raise
 
 # ========== CATEGORY ENDPOINTS ==========
 @app.route('/api/products/categories', methods=['GET'])
+@cached_response(max_age=app.config['CATEGORIES_MAX_AGE'])
 def get_product_categories():
     try:
         connection = get_db_connection()
@@ -1171,6 +3395,7 @@ def get_product_categories():
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/products/category/<string:category_slug>', methods=['GET'])
+@cached_response(max_age=app.config['PRODUCTS_MAX_AGE'])
 def get_products_by_category(category_slug):
     try:
         connection = get_db_connection()
@@ -1206,6 +3431,7 @@ def get_products_by_category(category_slug):
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/categories', methods=['GET'])
+@cached_response(max_age=app.config['CATEGORIES_MAX_AGE'])
 def get_categories():
     try:
         connection = get_db_connection()
@@ -1253,6 +3479,9 @@ def create_category():
                 category_id = cursor.lastrowid
 
             connection.commit()
+        invalidate_catalog_cache()
+        version = suggestion_versions.invalidate()
+        product_suggestions.upsert_category({'id': category_id, 'name': name, 'slug': slug}, version)
 
         return jsonify({
             "message": "Category created successfully",
@@ -1298,6 +3527,8 @@ def setup_default_categories():
                         })
 
             connection.commit()
+        invalidate_catalog_cache()
+        suggestion_versions.invalidate()
 
         return jsonify({
             "message": f"Created {len(created_categories)} categories",
@@ -1308,44 +3539,99 @@ def setup_default_categories():
         return jsonify({"error": str(e)}), 500
 
 # ========== ORDER ENDPOINTS ==========
+# Locks the ordered products and decrements their stock in one statement.
+# Rows are locked in ascending id order so concurrent checkouts touching the
+# same products queue behind each other instead of deadlocking. Returns a list
+# of shortages (nothing is decremented) or an empty list on success.
+def reserve_stock(cursor, items):
+    requested = {}
+    for item in items:
+        requested[item['product_id']] = requested.get(item['product_id'], 0) + item['quantity']
+
+    product_ids = sorted(requested)
+    placeholders = ', '.join(['%s'] * len(product_ids))
+    cursor.execute(
+        f"""SELECT id, name, quantity FROM products
+            WHERE id IN ({placeholders})
+            ORDER BY id
+            FOR UPDATE""",
+        product_ids
+    )
+    stock = {row['id']: row for row in cursor.fetchall()}
+
+    shortages = []
+    for product_id in product_ids:
+        available = (stock[product_id]['quantity'] or 0) if product_id in stock else 0
+        if available < requested[product_id]:
+            shortages.append({
+                "product_id": product_id,
+                "product_name": stock[product_id]['name'] if product_id in stock else None,
+                "requested": requested[product_id],
+                "available": available
+            })
+    if shortages:
+        return shortages
+
+    cases = ' '.join(['WHEN %s THEN %s'] * len(product_ids))
+    params = [value for product_id in product_ids for value in (product_id, requested[product_id])]
+    cursor.execute(
+        f"""UPDATE products SET quantity = quantity - CASE id {cases} END
+            WHERE id IN ({placeholders})""",
+        [*params, *product_ids]
+    )
+    return []
+
 @app.route('/api/orders', methods=['POST'])
 @token_required
 def create_order():
     try:
         data = request.form
         user_id = request.user_id
+        timer = PhaseTimer()
         connection = get_db_connection()
+        timer.mark('connect')
         with connection:
             with connection.cursor() as cursor:
-                cursor.execute("SELECT id FROM carts WHERE user_id = %s", (user_id,))
-                cart = cursor.fetchone()
-                if not cart:
-                    return jsonify({"error": "Cart not found"}), 404
-
+                # Cart and its lines in one query; a cart with no lines yields one row of NULLs
                 cursor.execute(
-                    """SELECT ci.*, p.name as product_name, p.price
-                       FROM cart_items ci
-                       JOIN products p ON ci.product_id = p.id
-                       WHERE ci.cart_id = %s""",
-                    (cart['id'],)
+                    """SELECT c.id AS cart_id, ci.product_id, ci.quantity,
+                              p.name AS product_name, p.price
+                       FROM carts c
+                       LEFT JOIN cart_items ci ON ci.cart_id = c.id
+                       LEFT JOIN products p ON ci.product_id = p.id
+                       WHERE c.user_id = %s""",
+                    (user_id,)
                 )
-                items = cursor.fetchall()
+                rows = cursor.fetchall()
+                timer.mark('load_cart')
+                if not rows:
+                    return jsonify({"error": "Cart not found"}), 404
+
+                cart_id = rows[0]['cart_id']
+                items = [row for row in rows if row['product_id'] is not None and row['price'] is not None]
                 if not items:
                     return jsonify({"error": "Cart is empty"}), 400
 
+                shortages = reserve_stock(cursor, items)
+                timer.mark('reserve_stock')
+                if shortages:
+                    connection.rollback()
+                    return jsonify({"error": "Insufficient stock", "shortages": shortages}), 409
+
                 subtotal = sum(item['price'] * item['quantity'] for item in items)
                 tax = 0
                 shipping = 0
                 total = subtotal + tax + shipping
 
-                # Insert order first
+                # The order number is generated up front so the order is written once
+                order_number = generate_order_number()
                 cursor.execute(
                     """INSERT INTO orders (
                         order_number, user_id, status, subtotal, tax_amount,
                         shipping_amount, total_amount, shipping_address, billing_address
                        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
                     (
-                        'TEMP',  # Temporary placeholder
+                        order_number,
                         user_id,
                         'pending',
                         subtotal,
@@ -1357,18 +3643,14 @@ def create_order():
                     )
                 )
                 order_id = cursor.lastrowid
-                # Update order_number with correct value
-                order_number = f"ORD-{datetime.datetime.now().strftime('%Y%m%d')}-{order_id}"
-                cursor.execute(
-                    "UPDATE orders SET order_number = %s WHERE id = %s",
-                    (order_number, order_id)
-                )
-
-                for item in items:
-                    cursor.execute(
-                        """INSERT INTO order_items (
-                            order_id, product_id, product_name, product_price, quantity, total_price
-                           ) VALUES (%s, %s, %s, %s, %s, %s)""",
+                timer.mark('insert_order')
+
+                # pymysql folds this into a single multi-row INSERT
+                cursor.executemany(
+                    """INSERT INTO order_items (
+                        order_id, product_id, product_name, product_price, quantity, total_price
+                       ) VALUES (%s, %s, %s, %s, %s, %s)""",
+                    [
                         (
                             order_id,
                             item['product_id'],
@@ -1377,108 +3659,773 @@ def create_order():
                             item['quantity'],
                             item['price'] * item['quantity']
                         )
-                    )
+                        for item in items
+                    ]
+                )
+                timer.mark('insert_items')
 
-                cursor.execute("DELETE FROM cart_items WHERE cart_id = %s", (cart['id'],))
-                cursor.execute("DELETE FROM carts WHERE id = %s", (cart['id'],))
+                cursor.execute("DELETE FROM cart_items WHERE cart_id = %s", (cart_id,))
+                cursor.execute("DELETE FROM carts WHERE id = %s", (cart_id,))
+                timer.mark('clear_cart')
 
             connection.commit()
-        return jsonify({"message": "Order created successfully", "order_id": order_id, "order_number": order_number}), 201
+            timer.mark('commit')
+        cart_changed(user_id)
+        logger.info(f"Created order {order_number} with {len(items)} lines: {timer.summary()}")
+        response = jsonify({"message": "Order created successfully", "order_id": order_id, "order_number": order_number})
+        response.headers['Server-Timing'] = timer.server_timing()
+        return response, 201
     except Exception as e:
         logger.error(f"Error in create_order: {str(e)}")  # Log detailed error
         return jsonify({"error": str(e)}), 500
 
 # ========== PAYMENT ENDPOINTS ==========
+# retryable: Daraja provably never received the request, so sending it again is safe.
+# unknown: the request may have been accepted; STK pushes are not idempotent, so
+# it must not be resent and is settled by its callback instead.
+class MpesaError(Exception):
+    def __init__(self, message, retryable=False, unknown=False):
+        super().__init__(message)
+        self.retryable = retryable
+        self.unknown = unknown
+
+# True only for failures before any bytes reached Daraja (connect timeout,
+# refused connection, DNS failure)
+def request_never_sent(error):
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.ConnectionError) and \
+        isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+# One keep-alive connection pool to the Daraja host, shared by all payment workers
+mpesa_session = requests.Session()
+mpesa_session.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=max(1, app.config['PAYMENT_WORKERS'])
+))
+
+# Caches the Daraja OAuth token (valid for about an hour). Once a token is
+# within MPESA_TOKEN_REFRESH_MARGIN of expiry, callers keep using it while one
+# background thread fetches a replacement. Only one fetch runs at a time, so
+# concurrent payments never stampede the token endpoint.
+class MpesaTokenCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+        self._stats = {'hits': 0, 'refreshes': 0, 'background_refreshes': 0, 'refresh_failures': 0}
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def _fetch(self):
+        url = f"{app.config['MPESA_BASE_URL']}/oauth/v1/generate?grant_type=client_credentials"
+        try:
+            r = mpesa_session.get(
+                url,
+                auth=HTTPBasicAuth(app.config['MPESA_CONSUMER_KEY'], app.config['MPESA_CONSUMER_SECRET']),
+                timeout=app.config['MPESA_TIMEOUT']
+            )
+            r.raise_for_status()
+            data = r.json()
+            token = data['access_token']
+            expires_in = float(data.get('expires_in', 3599))
+        except (requests.RequestException, ValueError, KeyError) as e:
+            self._count('refresh_failures')
+            raise MpesaError(f"Could not get M-Pesa access token: {str(e)}", retryable=True)
+
+        self._token = token
+        self._expires_at = time.monotonic() + expires_in
+        self._count('refreshes')
+        return token
+
+    def _refresh_in_background(self):
+        if not self._lock.acquire(blocking=False):
+            return  # another thread is already refreshing
+
+        def refresh():
+            try:
+                self._fetch()
+                self._count('background_refreshes')
+            except MpesaError as e:
+                logger.warning(str(e))
+            finally:
+                self._lock.release()
+
+        threading.Thread(target=refresh, name="mpesa-token-refresh", daemon=True).start()
+
+    def get(self):
+        token, expires_at = self._token, self._expires_at
+        now = time.monotonic()
+        if token and now < expires_at:
+            if now >= expires_at - app.config['MPESA_TOKEN_REFRESH_MARGIN']:
+                self._refresh_in_background()
+            self._count('hits')
+            return token
+
+        with self._lock:
+            # Another thread may have refreshed while we waited for the lock
+            if self._token and time.monotonic() < self._expires_at:
+                self._count('hits')
+                return self._token
+            return self._fetch()
+
+    # Drop a token Daraja rejected so the next call fetches a new one
+    def invalidate(self, token):
+        if self._token == token:
+            self._expires_at = 0.0
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['expires_in'] = max(0, round(self._expires_at - time.monotonic())) if self._token else None
+        return stats
+
+mpesa_tokens = MpesaTokenCache()
+
+# Sends the STK push and returns Daraja's CheckoutRequestID
+def send_stk_push(phone, amount):
+    access_token = mpesa_tokens.get()
+
+    timestamp = datetime.datetime.today().strftime('%Y%m%d%H%M%S')
+    business_short_code = app.config['MPESA_BUSINESS_SHORTCODE']
+    data = business_short_code + app.config['MPESA_PASSKEY'] + timestamp
+    password = base64.b64encode(data.encode()).decode('utf-8')
+
+    payload = {
+        "BusinessShortCode": business_short_code,
+        "Password": password,
+        "Timestamp": timestamp,
+        "TransactionType": "CustomerPayBillOnline",
+        "Amount": app.config['MPESA_TEST_AMOUNT'] or str(int(amount)),
+        "PartyA": phone,
+        "PartyB": business_short_code,
+        "PhoneNumber": phone,
+        "CallBackURL": app.config['MPESA_CALLBACK_URL'],
+        "AccountReference": "account",
+        "TransactionDesc": "account"
+    }
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    }
+
+    url = f"{app.config['MPESA_BASE_URL']}/mpesa/stkpush/v1/processrequest"
+    try:
+        response = mpesa_session.post(url, json=payload, headers=headers, timeout=app.config['MPESA_TIMEOUT'])
+    except requests.RequestException as e:
+        if request_never_sent(e):
+            raise MpesaError(f"STK push could not connect: {str(e)}", retryable=True)
+        raise MpesaError(f"STK push outcome unknown: {str(e)}", unknown=True)
+
+    if response.status_code == 401:
+        mpesa_tokens.invalidate(access_token)
+
+    # 401 and 429 are rejected before the push is processed
+    if response.status_code in (401, 429):
+        raise MpesaError(f"STK push returned HTTP {response.status_code}", retryable=True)
+    if response.status_code >= 500:
+        raise MpesaError(f"STK push outcome unknown: HTTP {response.status_code}", unknown=True)
+    try:
+        body = response.json()
+    except ValueError:
+        raise MpesaError(f"STK push returned invalid JSON (HTTP {response.status_code})",
+                         unknown=response.status_code == 200)
+    if response.status_code != 200 or str(body.get('ResponseCode')) != '0':
+        raise MpesaError(body.get('errorMessage') or body.get('ResponseDescription') or f"HTTP {response.status_code}")
+    return body['CheckoutRequestID']
+
+# Background threads draining payment_jobs (migrations/003_payment_jobs.sql).
+# Jobs are claimed with FOR UPDATE SKIP LOCKED, so workers in every process can
+# share the table; a job whose worker dies mid-push is parked as unknown, never resent.
+class PaymentWorkerPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._stats = {'claimed': 0, 'submitted': 0, 'retried': 0, 'failed': 0, 'unknown': 0, 'expired': 0, 'errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    # Threads do not survive a fork, so (re)start them once per process
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for i in range(app.config['PAYMENT_WORKERS']):
+                threading.Thread(target=self._run, name=f"payment-worker-{i}", daemon=True).start()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                self._count('errors')
+                logger.error(f"Payment worker failed to claim a job: {str(e)}")
+                job = None
+
+            if job is None:
+                try:
+                    self._expire_unknown()
+                except Exception as e:
+                    self._count('errors')
+                    logger.error(f"Payment worker failed to expire unknown jobs: {str(e)}")
+                self._wakeup.wait(app.config['PAYMENT_POLL_INTERVAL'])
+                self._wakeup.clear()
+                continue
+
+            try:
+                self._process(job)
+            except Exception as e:
+                self._count('errors')
+                logger.error(f"Payment worker failed on job {job['id']}: {str(e)}")
+
+    def _claim(self):
+        connection = get_db_connection()
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """SELECT id, payment_id, phone, amount, attempts
+                       FROM payment_jobs
+                       WHERE status = 'queued' AND next_attempt_at <= NOW()
+                       ORDER BY next_attempt_at
+                       LIMIT 1
+                       FOR UPDATE SKIP LOCKED"""
+                )
+                job = cursor.fetchone()
+                if not job:
+                    return None
+
+                cursor.execute(
+                    """UPDATE payment_jobs
+                       SET status = 'processing', attempts = attempts + 1,
+                           locked_until = NOW() + INTERVAL %s SECOND
+                       WHERE id = %s""",
+                    (app.config['PAYMENT_LEASE'], job['id'])
+                )
+            connection.commit()
+
+        job['attempts'] += 1
+        self._count('claimed')
+        return job
+
+    def _process(self, job):
+        try:
+            checkout_request_id = send_stk_push(job['phone'], job['amount'])
+        except MpesaError as e:
+            if e.unknown:
+                self._park(job, str(e))
+            else:
+                self._fail(job, str(e), e.retryable)
+            return
+
+        connection = get_db_connection()
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """UPDATE payment_jobs
+                       SET status = 'submitted', checkout_request_id = %s,
+                           locked_until = NULL, last_error = NULL
+                       WHERE id = %s""",
+                    (checkout_request_id, job['id'])
+                )
+                cursor.execute(
+                    "INSERT INTO mpesa_transactions (payment_id, checkout_request_id) VALUES (%s, %s)",
+                    (job['payment_id'], checkout_request_id)
+                )
+            connection.commit()
+        self._count('submitted')
+
+    # The push may have reached the customer's phone: never resend it, wait for
+    # the callback to be matched by phone (CallbackProcessor) or for the timeout
+    def _park(self, job, error):
+        connection = get_db_connection()
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """UPDATE payment_jobs
+                       SET status = 'unknown', last_error = %s, locked_until = NULL,
+                           next_attempt_at = NOW() + INTERVAL %s SECOND
+                       WHERE id = %s""",
+                    (error[:255], app.config['PAYMENT_UNKNOWN_TIMEOUT'], job['id'])
+                )
+            connection.commit()
+        self._count('unknown')
+        logger.warning(f"STK push for payment {job['payment_id']} has an unknown outcome: {error}")
+
+    # Jobs whose worker died mid-push are parked as unknown, and unknown jobs
+    # nobody claimed by callback within PAYMENT_UNKNOWN_TIMEOUT fail their payment
+    def _expire_unknown(self):
+        connection = get_db_connection()
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """UPDATE payment_jobs
+                       SET status = 'unknown', locked_until = NULL,
+                           last_error = 'Worker lease expired during STK push',
+                           next_attempt_at = NOW() + INTERVAL %s SECOND
+                       WHERE status = 'processing' AND locked_until < NOW()""",
+                    (app.config['PAYMENT_UNKNOWN_TIMEOUT'],)
+                )
+                cursor.execute(
+                    """SELECT id, payment_id FROM payment_jobs
+                       WHERE status = 'unknown' AND next_attempt_at <= NOW()
+                       FOR UPDATE SKIP LOCKED"""
+                )
+                expired = cursor.fetchall()
+                if not expired:
+                    connection.commit()
+                    return
+                placeholders = ', '.join(['%s'] * len(expired))
+                cursor.execute(
+                    f"UPDATE payment_jobs SET status = 'failed' WHERE id IN ({placeholders})",
+                    [job['id'] for job in expired]
+                )
+                cursor.execute(
+                    f"""UPDATE payments SET status = 'failed'
+                        WHERE id IN ({placeholders}) AND status = 'pending'""",
+                    [job['payment_id'] for job in expired]
+                )
+            connection.commit()
+        for job in expired:
+            self._count('expired')
+            payment_status_changed(job['payment_id'], 'failed')
+
+    def _fail(self, job, error, retryable):
+        will_retry = retryable and job['attempts'] < app.config['PAYMENT_MAX_ATTEMPTS']
+        connection = get_db_connection()
+        with connection:
+            with connection.cursor() as cursor:
+                if will_retry:
+                    # Exponential backoff with jitter so retries from many jobs spread out
+                    delay = min(
+                        app.config['PAYMENT_BACKOFF_MAX'],
+                        app.config['PAYMENT_BACKOFF_BASE'] * 2 ** (job['attempts'] - 1)
+                    ) * random.uniform(0.5, 1.0)
+                    cursor.execute(
+                        """UPDATE payment_jobs
+                           SET status = 'queued', last_error = %s, locked_until = NULL,
+                               next_attempt_at = NOW() + INTERVAL %s SECOND
+                           WHERE id = %s""",
+                        (error[:255], int(delay) + 1, job['id'])
+                    )
+                    self._count('retried')
+                else:
+                    cursor.execute(
+                        """UPDATE payment_jobs
+                           SET status = 'failed', last_error = %s, locked_until = NULL
+                           WHERE id = %s""",
+                        (error[:255], job['id'])
+                    )
+                    cursor.execute(
+                        "UPDATE payments SET status = 'failed' WHERE id = %s",
+                        (job['payment_id'],)
+                    )
+                    self._count('failed')
+            connection.commit()
+        logger.warning(f"STK push for payment {job['payment_id']} failed (attempt {job['attempts']}): {error}")
+        if not will_retry:
+            payment_status_changed(job['payment_id'], 'failed')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['workers'] = app.config['PAYMENT_WORKERS']
+        return stats
+
+payment_workers = PaymentWorkerPool()
+
+@app.before_request
+def start_background_workers():
+    payment_workers.ensure_started()
+    callback_processor.ensure_started()
+    image_workers.ensure_started()
+
+# Queues an STK push for the order and returns immediately; poll
+# GET /api/payments/<payment_id> for the outcome
 @app.route('/api/payments/mpesa', methods=['POST'])
+@token_required
 def mpesa_payment():
-    if request.method == 'POST':
-        amount = request.form['amount']
-        phone = request.form['phone']
-        # GENERATING THE ACCESS TOKEN
-        consumer_key = "GTWADFxIpUfDoNikNGqq1C3023evM6UH"
-        consumer_secret = "amFbAoUByPV2rM5A"
-
-        api_URL = "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"  # AUTH URL
-        r = requests.get(api_URL, auth=HTTPBasicAuth(consumer_key, consumer_secret))
-
-        data = r.json()
-        access_token = "Bearer" + ' ' + data['access_token']
-
-        #  GETTING THE PASSWORD
-        timestamp = datetime.datetime.today().strftime('%Y%m%d%H%M%S')
-        passkey = 'bfb279f9aa9bdbcf158e97dd71a467cd2e0c893059b10f78e6b72ada1ed2c919'
-        business_short_code = "174379"
-        data = business_short_code + passkey + timestamp
-        encoded = base64.b64encode(data.encode())
-        password = encoded.decode('utf-8')
-
-        # BODY OR PAYLOAD
-        payload = {
-            "BusinessShortCode": "174379",
-            "Password": "{}".format(password),
-            "Timestamp": "{}".format(timestamp),
-            "TransactionType": "CustomerPayBillOnline",
-            "Amount": "1",  # use 1 when testing
-            "PartyA": phone,  # change to your number
-            "PartyB": "174379",
-            "PhoneNumber": phone,
-            "CallBackURL": "https://modcom.co.ke/api/confirmation.php",
-            "AccountReference": "account",
-            "TransactionDesc": "account"
-        }
+    try:
+        data = request.form
+        order_id = data.get('order_id')
+        phone = data.get('phone', '')
 
-        # POPULAING THE HTTP HEADER
-        headers = {
-            "Authorization": access_token,
-            "Content-Type": "application/json"
-        }
+        if not order_id:
+            return jsonify({"error": "Order ID required"}), 400
+        if not re.match(r'^254[17]\d{8}$', phone):
+            return jsonify({"error": "Phone must be in the format 2547XXXXXXXX"}), 400
+
+        connection = get_db_connection()
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT id, total_amount FROM orders WHERE id = %s AND user_id = %s",
+                    (order_id, request.user_id)
+                )
+                order = cursor.fetchone()
+                if not order:
+                    return jsonify({"error": "Order not found"}), 404
+
+                cursor.execute(
+                    """INSERT INTO payments (order_id, amount, payment_method, status)
+                       VALUES (%s, %s, %s, %s)""",
+                    (order['id'], order['total_amount'], 'mpesa', 'pending')
+                )
+                payment_id = cursor.lastrowid
 
-        url = "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest"  # C2B URL
+                cursor.execute(
+                    "INSERT INTO payment_jobs (payment_id, phone, amount) VALUES (%s, %s, %s)",
+                    (payment_id, phone, order['total_amount'])
+                )
+            connection.commit()
+
+        payment_workers.notify()
+        return jsonify({
+            "message": "Please Complete Payment in Your Phone and we will deliver in minutes",
+            "payment_id": payment_id,
+            "status": "queued"
+        })
+
+    except Exception as e:
+        logger.error(f"Error queueing M-Pesa payment: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/payments/<int:payment_id>', methods=['GET'])
+@token_required
+def get_payment_status(payment_id):
+    try:
+        payment = fetch_payment(payment_id, request.user_id, request.is_admin)
+        if not payment:
+            return jsonify({"error": "Payment not found"}), 404
+        return jsonify(payment)
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def fetch_payment(payment_id, user_id, is_admin):
+    connection = get_db_connection()
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """SELECT p.id, p.order_id, p.amount, p.status,
+                          j.status AS job_status, j.attempts, j.last_error,
+                          j.checkout_request_id
+                   FROM payments p
+                   JOIN orders o ON p.order_id = o.id
+                   LEFT JOIN payment_jobs j ON j.payment_id = p.id
+                   WHERE p.id = %s AND (o.user_id = %s OR %s = TRUE)""",
+                (payment_id, user_id, is_admin)
+            )
+            return cursor.fetchone()
+
+PAYMENT_FINAL_STATUSES = ('completed', 'failed')
+
+def payment_event(payment_id, status):
+    return {"payment_id": payment_id, "status": status, "final": status in PAYMENT_FINAL_STATUSES}
+
+# Called once a payment's status has been committed
+def payment_status_changed(payment_id, status):
+    notification_bus.publish(f"payment:{payment_id}", {"status": status})
+
+# Server-sent events for the checkout page: the current status first, then each
+# change until the payment completes or fails. Changes applied in this process
+# are pushed immediately; the database is re-checked at every heartbeat for
+# ones applied elsewhere.
+@app.route('/api/payments/<int:payment_id>/events', methods=['GET'])
+def payment_events(payment_id):
+    error = authenticate_stream_request()
+    if error:
+        return error
+
+    user_id, is_admin = request.user_id, request.is_admin
+    try:
+        payment = fetch_payment(payment_id, user_id, is_admin)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if not payment:
+        return jsonify({"error": "Payment not found"}), 404
+
+    last_status = [payment['status']]
+
+    def render(message):
+        last_status[0] = message['status']
+        return payment_event(payment_id, message['status'])
 
-        response = requests.post(url, json=payload, headers=headers)
-        print(response.text)
-        return jsonify({"message": "Please Complete Payment in Your Phone and we will deliver in minutes"})
+    def on_idle():
+        try:
+            current = fetch_payment(payment_id, user_id, is_admin)
+        except Exception as e:
+            logger.error(f"Error polling payment {payment_id}: {str(e)}")
+            return None
+        if not current or current['status'] == last_status[0]:
+            return None
+        return render({"status": current['status']})
+
+    return sse_response(f"payment:{payment_id}", render, payment_event(payment_id, payment['status']), on_idle)
 
 # ========CALL_BACK ENDPOINT=======
-@app.route('/api/mpesa_callback', methods=['POST'])
-def mpesa_callback():
+# Applies rows from mpesa_callback_inbox (migrations/004_mpesa_callback_inbox.sql
+# and 009_callback_inbox_retry.sql) in batches. Status changes only move
+# payments out of 'pending', so replaying a batch after a crash is harmless.
+# A push whose response was lost has no CheckoutRequestID on record. Success
+# callbacks carry the paying phone number, which identifies the unknown-outcome
+# job it belongs to; the job is then recorded as submitted under that id.
+# Failure callbacks carry no phone, so those jobs settle by timeout instead.
+def adopt_unknown_push(cursor, row):
+    if row['result_code'] != 0:
+        return None
     try:
-        data = request.get_json()
-        logger.info(f"M-Pesa Callback received: {data}")
+        callback = json.loads(row['payload'])['Body']['stkCallback']
+        items = callback['CallbackMetadata']['Item']
+        phone = str(next(item['Value'] for item in items if item.get('Name') == 'PhoneNumber'))
+    except (ValueError, KeyError, TypeError, StopIteration):
+        return None
+
+    cursor.execute(
+        """SELECT id, payment_id FROM payment_jobs
+           WHERE status = 'unknown' AND phone = %s
+           ORDER BY id
+           LIMIT 1
+           FOR UPDATE SKIP LOCKED""",
+        (phone,)
+    )
+    job = cursor.fetchone()
+    if not job:
+        return None
+    cursor.execute(
+        """UPDATE payment_jobs SET status = 'submitted', checkout_request_id = %s, last_error = NULL
+           WHERE id = %s""",
+        (row['checkout_request_id'], job['id'])
+    )
+    cursor.execute(
+        "INSERT INTO mpesa_transactions (payment_id, checkout_request_id) VALUES (%s, %s)",
+        (job['payment_id'], row['checkout_request_id'])
+    )
+    return job['payment_id']
+
+class CallbackProcessor:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._stats = {
+            'received': 0,
+            'duplicates': 0,
+            'batches': 0,
+            'applied': 0,
+            'unmatched': 0,
+            'deferred': 0,
+            'errors': 0,
+            'last_lag_ms': None,
+            'max_lag_ms': 0.0,
+            'total_lag_ms': 0.0
+        }
 
-        # Extract relevant data from callback
-        checkout_request_id = data.get('Body', {}).get('stkCallback', {}).get('CheckoutRequestID')
-        result_code = data.get('Body', {}).get('stkCallback', {}).get('ResultCode')
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="mpesa-callback-processor", daemon=True).start()
+
+    def record_received(self, duplicate):
+        with self._lock:
+            self._stats['duplicates' if duplicate else 'received'] += 1
+        if not duplicate:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                processed = self.process_batch()
+            except Exception as e:
+                with self._lock:
+                    self._stats['errors'] += 1
+                logger.error(f"Callback processor failed: {str(e)}")
+                processed = 0
 
+            # Keep draining while batches come back full
+            if processed < app.config['CALLBACK_BATCH_SIZE']:
+                self._wakeup.wait(app.config['CALLBACK_POLL_INTERVAL'])
+                self._wakeup.clear()
+
+    def process_batch(self):
         connection = get_db_connection()
         with connection:
             with connection.cursor() as cursor:
                 cursor.execute(
-                    "SELECT payment_id FROM mpesa_transactions WHERE checkout_request_id = %s",
-                    (checkout_request_id,)
+                    """SELECT id, checkout_request_id, result_code, payload,
+                              TIMESTAMPDIFF(MICROSECOND, received_at, NOW(3)) AS lag_us,
+                              received_at < NOW() - INTERVAL %s SECOND AS expired
+                       FROM mpesa_callback_inbox
+                       WHERE processed_at IS NULL AND (retry_at IS NULL OR retry_at <= NOW(3))
+                       ORDER BY id
+                       LIMIT %s
+                       FOR UPDATE SKIP LOCKED""",
+                    (app.config['CALLBACK_UNMATCHED_AFTER'], app.config['CALLBACK_BATCH_SIZE'])
                 )
-                transaction = cursor.fetchone()
-
-                if not transaction:
-                    logger.error("Transaction not found for CheckoutRequestID: %s", checkout_request_id)
-                    return jsonify({"error": "Transaction not found"}), 404
+                rows = cursor.fetchall()
+                if not rows:
+                    return 0
 
-                # Update payment status based on result
-                status = 'completed' if result_code == 0 else 'failed'
+                placeholders = ', '.join(['%s'] * len(rows))
                 cursor.execute(
-                    "UPDATE payments SET status = %s WHERE id = %s",
-                    (status, transaction['payment_id'])
+                    f"""SELECT checkout_request_id, payment_id FROM mpesa_transactions
+                        WHERE checkout_request_id IN ({placeholders})""",
+                    [row['checkout_request_id'] for row in rows]
                 )
-                if result_code == 0:
+                payments = {t['checkout_request_id']: t['payment_id'] for t in cursor.fetchall()}
+                for row in rows:
+                    if row['checkout_request_id'] not in payments:
+                        payment_id = adopt_unknown_push(cursor, row)
+                        if payment_id is not None:
+                            payments[row['checkout_request_id']] = payment_id
+
+                completed, failed, applied, unmatched, deferred = [], [], [], [], []
+                for row in rows:
+                    payment_id = payments.get(row['checkout_request_id'])
+                    if payment_id is None:
+                        # The STK push may not be recorded yet; give it time before
+                        # giving up, but step past it so newer callbacks are not held back
+                        (unmatched if row['expired'] else deferred).append(row['id'])
+                        continue
+                    (completed if row['result_code'] == 0 else failed).append(payment_id)
+                    applied.append(row)
+
+                if completed:
+                    placeholders = ', '.join(['%s'] * len(completed))
+                    cursor.execute(
+                        f"""UPDATE payments SET status = 'completed'
+                            WHERE id IN ({placeholders}) AND status = 'pending'""",
+                        completed
+                    )
+                    # Only orders still awaiting payment move, and only for payments
+                    # that really completed: a replayed callback or one for an
+                    # already failed payment must not complete or regress an order
+                    cursor.execute(
+                        f"""UPDATE orders o
+                            JOIN payments p ON p.order_id = o.id
+                            SET o.status = 'completed'
+                            WHERE p.id IN ({placeholders})
+                              AND p.status = 'completed'
+                              AND o.status = 'pending'""",
+                        completed
+                    )
+                if failed:
+                    placeholders = ', '.join(['%s'] * len(failed))
                     cursor.execute(
-                        "UPDATE orders SET status = %s WHERE id = (SELECT order_id FROM payments WHERE id = %s)",
-                        ('completed', transaction['payment_id'])
+                        f"""UPDATE payments SET status = 'failed'
+                            WHERE id IN ({placeholders}) AND status = 'pending'""",
+                        failed
                     )
 
+                for outcome, ids in (('applied', [row['id'] for row in applied]), ('unmatched', unmatched)):
+                    if ids:
+                        placeholders = ', '.join(['%s'] * len(ids))
+                        cursor.execute(
+                            f"""UPDATE mpesa_callback_inbox SET processed_at = NOW(3), outcome = %s
+                                WHERE id IN ({placeholders})""",
+                            [outcome, *ids]
+                        )
+                if deferred:
+                    placeholders = ', '.join(['%s'] * len(deferred))
+                    cursor.execute(
+                        f"""UPDATE mpesa_callback_inbox SET retry_at = NOW(3) + INTERVAL %s SECOND
+                            WHERE id IN ({placeholders})""",
+                        [app.config['CALLBACK_RETRY_INTERVAL'], *deferred]
+                    )
             connection.commit()
 
-        return jsonify({"message": "Callback processed successfully"})
+        for payment_id in completed:
+            payment_status_changed(payment_id, 'completed')
+        for payment_id in failed:
+            payment_status_changed(payment_id, 'failed')
+
+        with self._lock:
+            self._stats['batches'] += 1
+            self._stats['applied'] += len(applied)
+            self._stats['unmatched'] += len(unmatched)
+            self._stats['deferred'] += len(deferred)
+            for row in applied:
+                lag_ms = (row['lag_us'] or 0) / 1000
+                self._stats['last_lag_ms'] = lag_ms
+                self._stats['max_lag_ms'] = max(self._stats['max_lag_ms'], lag_ms)
+                self._stats['total_lag_ms'] += lag_ms
+        # Deferred rows do not count, so a batch of them never keeps _run spinning
+        return len(applied) + len(unmatched)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        total = stats.pop('total_lag_ms')
+        stats['avg_lag_ms'] = round(total / stats['applied'], 3) if stats['applied'] else None
+        return stats
+
+callback_processor = CallbackProcessor()
+
+# Safaricom retries callbacks until it gets a quick 200, so this only appends
+# the payload to the inbox; duplicates are dropped by the unique key
+@app.route('/api/mpesa_callback', methods=['POST'])
+def mpesa_callback():
+    try:
+        data = request.get_json(silent=True) or {}
+        stk_callback = data.get('Body', {}).get('stkCallback', {})
+        checkout_request_id = stk_callback.get('CheckoutRequestID')
+        result_code = stk_callback.get('ResultCode')
+
+        if not checkout_request_id:
+            logger.error("M-Pesa callback without CheckoutRequestID")
+            return jsonify({"error": "CheckoutRequestID missing"}), 400
+
+        connection = get_db_connection()
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """INSERT IGNORE INTO mpesa_callback_inbox (checkout_request_id, result_code, payload)
+                       VALUES (%s, %s, %s)""",
+                    (checkout_request_id, result_code, json.dumps(data))
+                )
+                duplicate = cursor.rowcount == 0
+            connection.commit()
+
+        callback_processor.record_received(duplicate)
+        return jsonify({"ResultCode": 0, "ResultDesc": "Accepted"})
 
     except Exception as e:
         logger.error(f"Error processing callback: {str(e)}")
         return jsonify({"error": str(e)}), 500
+
+# ========== ADMIN METRICS ==========
+@app.route('/api/admin/metrics', methods=['GET'])
+@token_required
+@admin_required
+def get_metrics():
+    return jsonify({
+        "db_pool": db_pool.stats(),
+        "catalog_cache": catalog_cache.stats(),
+        "notifications": notification_bus.stats(),
+        "payment_workers": payment_workers.stats(),
+        "mpesa_token": mpesa_tokens.stats(),
+        "mpesa_callbacks": callback_processor.stats(),
+        "auth_tokens": verified_tokens.stats(),
+        "suspended_users": suspended_users.stats(),
+        "password_hasher": password_hasher.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "image_workers": image_workers.stats(),
+        "image_blobs": dict(blob_stats),
+        "static_files": static_files.stats()
+    })
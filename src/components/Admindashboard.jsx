@@ -192,7 +192,7 @@ const AdminDashboard = () => {
                         <td>
                           <img 
                             src={product.images?.[0]?.image_url 
-                              ? `https://saraicollection.pythonanywhere.com/static/images/${product.images[0].image_url}` 
+                              ? `https://saraicollection.pythonanywhere.com/static/images/${product.images[0].variants?.thumb?.webp || product.images[0].image_url}` 
                               : '/placeholder-product.jpg'} 
                             alt={product.name}
                             style={{ width: '50px', height: '50px', objectFit: 'cover' }}
@@ -204,7 +204,7 @@ const Cart = () => {
 
   const getImageUrl = (item) => {
     if (item.product_image) {
-      return `https://saraicollection.pythonanywhere.com/static/images/${item.product_image}`;
+      return `https://saraicollection.pythonanywhere.com/static/images/${item.product_thumb || item.product_image}`;
     }
     return '/assets/images/def.png';
   };
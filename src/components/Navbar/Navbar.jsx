@@ -33,10 +33,10 @@ const Navbar = () => {
         try {
           setUser(JSON.parse(userData));
           setIsCartLoading(true);
-          const response = await axios.get('https://saraicollection.pythonanywhere.com/api/cart', {
+          const response = await axios.get('https://saraicollection.pythonanywhere.com/api/cart/summary', {
             headers: { Authorization: `Bearer ${token}` },
           });
-          setCartCount(response.data?.items?.length || 0);
+          setCartCount(response.data?.item_count || 0);
         } catch (err) {
           console.error('Error fetching cart:', err);
           if (err.response?.status === 401) {
@@ -66,11 +66,11 @@ const Navbar = () => {
       if (token) {
         try {
           setIsCartLoading(true);
-          const response = await axios.get('https://saraicollection.pythonanywhere.com/api/cart', {
+          const response = await axios.get('https://saraicollection.pythonanywhere.com/api/cart/summary', {
             headers: { Authorization: `Bearer ${token}` },
           });
           console.log('Navbar cart API response:', response.data); // Debug
-          setCartCount(response.data?.items?.length || 0);
+          setCartCount(response.data?.item_count || 0);
         } catch (err) {
           console.error('Error fetching cart on update:', err);
           setCartCount(0);
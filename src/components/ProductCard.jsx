@@ -25,8 +25,9 @@ const ProductCard = ({ product }) => {
     stock_quantity = null // Add this if available from your API
   } = product || {};
 
+  // Prefer the resized card variant once the server has rendered it
   const imageUrl = images.length > 0 
-    ? `https://saraicollection.pythonanywhere.com/static/images/${images[0].image_url}`
+    ? `https://saraicollection.pythonanywhere.com/static/images/${images[0].variants?.card?.webp || images[0].image_url}`
     : defaultImage;
 
   const formatPrice = (amount) => {
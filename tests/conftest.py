@@ -0,0 +1,103 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sarai  # noqa: E402
+
+requires_db = pytest.mark.skipif(
+    not os.getenv('DB_HOST'),
+    reason="set DB_HOST (and DB_USER/DB_PASSWORD/DB_NAME) to a MySQL/MariaDB with the schema and migrations applied"
+)
+
+# Benchmarks seed large synthetic tables, so they also need an explicit opt-in;
+# run them with -s to see the timings they print
+requires_benchmark = pytest.mark.skipif(
+    not (os.getenv('DB_HOST') and os.getenv('RUN_BENCHMARKS')),
+    reason="set DB_HOST and RUN_BENCHMARKS=1 to run benchmarks"
+)
+
+@pytest.fixture
+def app():
+    # Keep the payment, callback and image workers from starting in tests
+    for pool in (sarai.payment_workers, sarai.callback_processor, sarai.image_workers):
+        pool._pid = os.getpid()
+    sarai.app.config['TESTING'] = True
+    return sarai.app
+
+@pytest.fixture
+def db():
+    connection = sarai.get_db_connection()
+    yield connection
+    connection.close()
+
+@pytest.fixture
+def make_user(db):
+    created = []
+
+    def make():
+        suffix = uuid.uuid4().hex[:12]
+        with db.cursor() as cursor:
+            cursor.execute(
+                """INSERT INTO users (username, email, password_hash, first_name, last_name, phone, is_admin)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                (f"test_{suffix}", f"test_{suffix}@example.com", '', 'Test', '', '', False)
+            )
+            user_id = cursor.lastrowid
+        db.commit()
+        created.append(user_id)
+        return {'id': user_id, 'token': sarai.generate_token(user_id, False)}
+
+    yield make
+    with db.cursor() as cursor:
+        for user_id in created:
+            cursor.execute(
+                "DELETE ci FROM cart_items ci JOIN carts c ON ci.cart_id = c.id WHERE c.user_id = %s",
+                (user_id,)
+            )
+            cursor.execute("DELETE FROM carts WHERE user_id = %s", (user_id,))
+            cursor.execute(
+                "DELETE oi FROM order_items oi JOIN orders o ON oi.order_id = o.id WHERE o.user_id = %s",
+                (user_id,)
+            )
+            cursor.execute("DELETE FROM orders WHERE user_id = %s", (user_id,))
+            cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
+    db.commit()
+
+@pytest.fixture
+def user(make_user):
+    return make_user()
+
+@pytest.fixture
+def make_product(db):
+    created = []
+
+    def make(quantity=100, price=10, name=None, description=''):
+        suffix = uuid.uuid4().hex[:12]
+        with db.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO categories (name, slug, description, is_active) VALUES (%s, %s, %s, %s)",
+                (f"Test {suffix}", f"test-{suffix}", '', True)
+            )
+            category_id = cursor.lastrowid
+            cursor.execute(
+                """INSERT INTO products (name, slug, description, price, quantity, category_id, is_active)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                (name or f"Test {suffix}", f"test-{suffix}", description, price, quantity, category_id, True)
+            )
+            product_id = cursor.lastrowid
+        db.commit()
+        created.append((product_id, category_id))
+        return product_id
+
+    yield make
+    with db.cursor() as cursor:
+        for product_id, category_id in created:
+            cursor.execute("DELETE FROM cart_items WHERE product_id = %s", (product_id,))
+            cursor.execute("DELETE FROM order_items WHERE product_id = %s", (product_id,))
+            cursor.execute("DELETE FROM products WHERE id = %s", (product_id,))
+            cursor.execute("DELETE FROM categories WHERE id = %s", (category_id,))
+    db.commit()
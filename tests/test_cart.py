@@ -0,0 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import requires_db
+
+@requires_db
+def test_parallel_adds_are_not_lost(app, db, user, make_product):
+    product_id = make_product()
+    headers = {'Authorization': f"Bearer {user['token']}"}
+
+    def add(_):
+        with app.test_client() as client:
+            return client.post('/api/cart/add', data={'product_id': product_id, 'quantity': 1},
+                               headers=headers).status_code
+
+    with ThreadPoolExecutor(max_workers=50) as executor:
+        statuses = list(executor.map(add, range(50)))
+
+    assert statuses == [200] * 50
+    with db.cursor() as cursor:
+        cursor.execute(
+            """SELECT ci.quantity FROM cart_items ci JOIN carts c ON ci.cart_id = c.id
+               WHERE c.user_id = %s AND ci.product_id = %s""",
+            (user['id'], product_id)
+        )
+        rows = cursor.fetchall()
+    db.commit()
+    assert [row['quantity'] for row in rows] == [50]
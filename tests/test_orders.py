@@ -0,0 +1,92 @@
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g
+
+from conftest import requires_db
+
+@requires_db
+def test_concurrent_checkouts_do_not_oversell(app, db, make_user, make_product):
+    stock = 20
+    first, second = make_product(quantity=stock), make_product(quantity=stock)
+    users = [make_user() for _ in range(40)]
+
+    # Half the carts list the products in the opposite order, so a checkout
+    # that locked rows in cart order would deadlock against the other half
+    with app.test_client() as client:
+        for n, user in enumerate(users):
+            headers = {'Authorization': f"Bearer {user['token']}"}
+            for product_id in ((first, second) if n % 2 else (second, first)):
+                response = client.post('/api/cart/add', data={'product_id': product_id, 'quantity': 1},
+                                       headers=headers)
+                assert response.status_code == 200
+
+    def checkout(user):
+        with app.test_client() as client:
+            return client.post('/api/orders', data={'shipping_address': 'Test'},
+                               headers={'Authorization': f"Bearer {user['token']}"}).status_code
+
+    with ThreadPoolExecutor(max_workers=len(users)) as executor:
+        statuses = list(executor.map(checkout, users))
+
+    # A deadlock or lock wait timeout surfaces as a 500
+    assert sorted(statuses) == [201] * stock + [409] * (len(users) - stock)
+    with db.cursor() as cursor:
+        cursor.execute("SELECT id, quantity FROM products WHERE id IN (%s, %s)", (first, second))
+        remaining = {row['id']: row['quantity'] for row in cursor.fetchall()}
+        cursor.execute(
+            "SELECT product_id, SUM(quantity) AS sold FROM order_items WHERE product_id IN (%s, %s) GROUP BY product_id",
+            (first, second)
+        )
+        sold = {row['product_id']: int(row['sold']) for row in cursor.fetchall()}
+    db.commit()
+    assert remaining == {first: 0, second: 0}
+    assert sold == {first: stock, second: stock}
+
+def fill_cart(db, user_id, product_ids):
+    with db.cursor() as cursor:
+        cursor.execute("INSERT INTO carts (user_id) VALUES (%s)", (user_id,))
+        cart_id = cursor.lastrowid
+        cursor.executemany(
+            "INSERT INTO cart_items (cart_id, product_id, quantity) VALUES (%s, %s, %s)",
+            [(cart_id, product_id, 1) for product_id in product_ids]
+        )
+    db.commit()
+
+# Checkout cost must not grow with the number of cart lines: the statement
+# count is asserted equal for 1, 10 and 100 lines, and timings are printed
+# (run with -s to see them)
+@requires_db
+def test_checkout_statement_count_is_independent_of_cart_size(app, db, user, make_product):
+    product_ids = [make_product() for _ in range(100)]
+    headers = {'Authorization': f"Bearer {user['token']}"}
+    runs = 5
+    queries, timings = {}, {}
+
+    for lines in (1, 10, 100):
+        for _ in range(runs):
+            fill_cart(db, user['id'], product_ids[:lines])
+            with app.test_client() as client:
+                started = time.perf_counter()
+                response = client.post('/api/orders', data={'shipping_address': 'Test'}, headers=headers)
+                elapsed = (time.perf_counter() - started) * 1000
+                assert response.status_code == 201
+                queries.setdefault(lines, []).append(g.db_queries)
+            phases = dict(
+                (name, float(duration.split('=')[1]))
+                for name, duration in (phase.split(';') for phase in response.headers['Server-Timing'].split(', '))
+            )
+            timings.setdefault(lines, []).append((elapsed, phases))
+
+    for lines, samples in timings.items():
+        elapsed = statistics.median(sample[0] for sample in samples)
+        phases = ', '.join(
+            f"{name} {statistics.median(sample[1][name] for sample in samples):.2f}"
+            for name in samples[0][1]
+        )
+        print(f"\n{lines:>3} lines: {min(queries[lines])} statements, p50 {elapsed:.1f} ms ({phases})")
+
+    # The minimum ignores runs where authentication also refreshed its
+    # suspended-user list, which is unrelated to the cart
+    assert min(queries[1]) == min(queries[10]) == min(queries[100])
@@ -0,0 +1,39 @@
+import pytest
+
+import sarai
+
+# Stands in for a DictCursor: counts round trips and answers the images query
+# with two images per requested product
+class CountingCursor:
+    def __init__(self):
+        self.executes = 0
+        self._rows = []
+
+    def execute(self, sql, params=None):
+        self.executes += 1
+        self._rows = [
+            {'product_id': product_id, 'image_url': f"{product_id}-{n}.jpg", 'is_primary': n == 0,
+             'sort_order': n, 'variants': '{"thumb": {"webp": "thumb.webp"}}'}
+            for product_id in params
+            for n in range(2)
+        ]
+
+    def fetchall(self):
+        return self._rows
+
+@pytest.mark.parametrize('count', [1, 10, 100])
+def test_fetch_product_images_is_one_round_trip(count):
+    cursor = CountingCursor()
+    product_ids = list(range(1, count + 1))
+
+    images = sarai.fetch_product_images(cursor, product_ids)
+
+    assert cursor.executes == 1
+    assert sorted(images) == product_ids
+    assert all(len(images[product_id]) == 2 for product_id in product_ids)
+    assert images[1][0]['variants'] == {'thumb': {'webp': 'thumb.webp'}}
+
+def test_fetch_product_images_skips_the_query_without_products():
+    cursor = CountingCursor()
+    assert sarai.fetch_product_images(cursor, []) == {}
+    assert cursor.executes == 0
@@ -0,0 +1,110 @@
+import statistics
+import time
+import uuid
+
+import pytest
+
+import sarai
+from conftest import requires_benchmark, requires_db
+
+@pytest.mark.parametrize('search, expected', [
+    ('red hood', '+red* +hood*'),
+    ('Black T-Shirt for men', '+Black* +Shirt* +men*'),
+    ('t-shirt', '+shirt*'),
+    ('hoodie for men', '+hoodie* +men*'),
+    ('the', ''),
+    ('t', ''),
+])
+def test_fulltext_query_drops_words_the_index_never_holds(search, expected):
+    assert sarai.fulltext_query(search) == expected
+
+def test_fulltext_query_follows_the_server_token_size():
+    assert sarai.fulltext_query('tee for him', min_token_size=4) == ''
+    assert sarai.fulltext_query('tee for him', min_token_size=2) == '+tee* +him*'
+
+def category_of(db, product_id):
+    with db.cursor() as cursor:
+        cursor.execute("SELECT category_id FROM products WHERE id = %s", (product_id,))
+        category_id = cursor.fetchone()['category_id']
+    db.commit()
+    return category_id
+
+@requires_db
+@pytest.mark.parametrize('search', ['t-shirt', 'T-Shirt', 'hoodie for men', 'shirt', 'for'])
+def test_storefront_searches_find_products(app, db, make_product, search):
+    product_id = make_product(name='Black T-Shirt for men',
+                             description='Cotton t-shirt, pairs with our hoodie for men')
+    with app.test_client() as client:
+        response = client.get('/api/products', query_string={
+            'search': search, 'category_id': category_of(db, product_id)})
+    assert response.status_code == 200
+    assert [product['id'] for product in response.get_json()] == [product_id]
+
+# Synthetic catalog for the search benchmark, removed afterwards
+@pytest.fixture
+def large_catalog(db):
+    size = 100_000
+    colors = ['black', 'white', 'red', 'navy', 'olive', 'grey', 'beige', 'maroon']
+    items = ['t-shirt', 'hoodie', 'jacket', 'dress', 'sweater', 'jeans', 'skirt', 'blazer', 'cardigan']
+    suffix = uuid.uuid4().hex[:12]
+    with db.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO categories (name, slug, description, is_active) VALUES (%s, %s, %s, %s)",
+            (f"Bench {suffix}", f"bench-{suffix}", '', True)
+        )
+        category_id = cursor.lastrowid
+        for start in range(0, size, 5000):
+            cursor.executemany(
+                """INSERT INTO products (name, slug, description, price, quantity, category_id, is_active)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                [
+                    (
+                        f"{colors[n % len(colors)].title()} {items[n % len(items)].title()} {n}",
+                        f"bench-{suffix}-{n}",
+                        f"A {colors[(n // 7) % len(colors)]} {items[(n // 3) % len(items)]} for men and women",
+                        10 + n % 90, 100, category_id, True
+                    )
+                    for n in range(start, min(start + 5000, size))
+                ]
+            )
+            db.commit()
+    yield category_id
+    with db.cursor() as cursor:
+        cursor.execute("DELETE FROM products WHERE category_id = %s", (category_id,))
+        cursor.execute("DELETE FROM categories WHERE id = %s", (category_id,))
+    db.commit()
+
+@requires_benchmark
+def test_search_latency_on_100k_products(app, db, large_catalog):
+    with db.cursor() as cursor:
+        if not sarai.has_fulltext_index(cursor):
+            pytest.skip("apply migrations/001_products_fulltext.sql first")
+    db.commit()
+
+    # Every keystroke of a few typed queries, each timed on a cold catalog cache
+    typed = ['hoodie for men', 'black t-shirt', 'navy blazer', 'olive cardigan']
+    queries = [text[:n] for text in typed for n in range(2, len(text) + 1)]
+
+    def run(label):
+        timings = []
+        with app.test_client() as client:
+            for query in queries:
+                sarai.invalidate_catalog_cache()
+                started = time.perf_counter()
+                response = client.get('/api/products', query_string={
+                    'search': query, 'category_id': large_catalog, 'page_size': 24})
+                timings.append((time.perf_counter() - started) * 1000)
+                assert response.status_code == 200
+        timings.sort()
+        p50 = statistics.median(timings)
+        p95 = timings[int(len(timings) * 0.95) - 1]
+        print(f"\n{label}: {len(timings)} searches, p50 {p50:.1f} ms, p95 {p95:.1f} ms")
+        return p50
+
+    fulltext = run('FULLTEXT')
+    sarai._fulltext_index_available = False
+    try:
+        like = run('LIKE fallback')
+    finally:
+        sarai._fulltext_index_available = None
+    print(f"FULLTEXT p50 is {like / fulltext:.1f}x faster than LIKE")